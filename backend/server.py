@@ -1,12 +1,15 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, UploadFile, Form, status
+from fastapi import FastAPI, APIRouter, BackgroundTasks, HTTPException, Depends, File, UploadFile, Form, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 import logging
 from pathlib import Path
@@ -14,17 +17,221 @@ from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional
 import uuid
 import base64
+import binascii
+import hashlib
+import tempfile
+from contextlib import contextmanager
 import shutil
+import json
+import asyncio
+import argparse
+import orjson
+import re
+import time
+import random
+import mimetypes
+import contextvars
+import threading
+import multiprocessing
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlencode
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it only originals are served
+    Image = None
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # pyinstrument is only needed for PROFILE_SLOW_REQUESTS_MS
+    Profiler = None
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Request profiling
+# Each HTTP request gets a RequestStats in a context variable. The MongoDB
+# command listener and timed_section() add to it, and RequestProfilingMiddleware
+# turns it into metrics and a Server-Timing header once the response starts.
+#
+# QUERY_DEBUG=warn|raise additionally records the shape of every command (its
+# filter with the values blanked out) so repeated identical queries and routes
+# over their round-trip budget can be reported; see QUERY_BUDGETS.
+QUERY_DEBUG = os.environ.get("QUERY_DEBUG", "off")
+class RequestStats:
+    """Time spent in the database and in named helpers during one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_round_trips = 0
+        self.db_seconds = 0.0
+        self.sections = defaultdict(float)
+        self.command_shapes = defaultdict(int)
+        # Command events arrive on Motor's executor threads
+        self._lock = threading.Lock()
+
+    def add_db_command(self, seconds: float):
+        with self._lock:
+            self.db_round_trips += 1
+            self.db_seconds += seconds
+
+    def add_section(self, name: str, seconds: float):
+        with self._lock:
+            self.sections[name] += seconds
+
+    def add_command_shape(self, shape: str):
+        with self._lock:
+            self.command_shapes[shape] += 1
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+
+@contextmanager
+def timed_section(name: str):
+    """Attribute the time spent in the block to `name` on the current request"""
+    stats = request_stats.get()
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add_section(name, time.perf_counter() - started)
+
+# Fields that vary between otherwise identical commands, and commands that are
+# legitimately repeated (cursor batches, driver housekeeping)
+VOLATILE_COMMAND_FIELDS = {
+    "lsid", "$db", "$clusterTime", "$readPreference", "txnNumber", "documents", "ordered",
+    "cursor", "batchSize", "limit", "skip", "maxTimeMS", "comment",
+}
+UNSHAPED_COMMANDS = {"getMore", "killCursors", "endSessions", "hello", "isMaster", "ping"}
+
+def value_shape(value):
+    """Replace the values in a filter or pipeline with placeholders, keeping field names and operators"""
+    if isinstance(value, dict):
+        return {k: value_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        # $in lists and batched updates have the same shape whatever their length
+        shapes = []
+        for item in value:
+            shape = value_shape(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return "?"
+
+def command_shape(command_name: str, command) -> str:
+    """e.g. 'find users {"filter": {"id": "?"}, "projection": {"_id": "?"}}'"""
+    body = {
+        k: value_shape(v) for k, v in command.items()
+        if k != command_name and k not in VOLATILE_COMMAND_FIELDS
+    }
+    return f"{command_name} {command.get(command_name)} {json.dumps(body, default=str)}"
+
+class CommandStatsListener(monitoring.CommandListener):
+    """Counts MongoDB round trips and their duration against the current request"""
+
+    def started(self, event):
+        if QUERY_DEBUG == "off" or event.command_name in UNSHAPED_COMMANDS:
+            return
+        stats = request_stats.get()
+        if stats is not None:
+            stats.add_command_shape(command_shape(event.command_name, event.command))
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    @staticmethod
+    def _record(event):
+        # Motor copies the caller's context onto its executor threads
+        stats = request_stats.get()
+        if stats is not None:
+            stats.add_db_command(event.duration_micros / 1_000_000)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[CommandStatsListener()])
 db = client[os.environ['DB_NAME']]
 
+# Indexes for every query shape used by the routes below.
+# create_indexes is idempotent, so this set is applied on every startup.
+INDEXES = {
+    "users": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("email", ASCENDING)], unique=True, name="email_unique"),
+    ],
+    "products": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        # Feed indexes end in id so keyset pagination on (created_at, id) never sorts in memory
+        IndexModel([("is_sold", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="feed"),
+        IndexModel(
+            [("seller_id", ASCENDING), ("is_sold", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+            name="seller_feed",
+        ),
+        IndexModel(
+            [("category", ASCENDING), ("is_sold", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+            name="category_feed",
+        ),
+        IndexModel(
+            [("title", TEXT), ("description", TEXT), ("tags", TEXT)],
+            weights={"title": 10, "tags": 5, "description": 1},
+            name="search",
+        ),
+        IndexModel([("keywords", ASCENDING), ("is_sold", ASCENDING)], name="keywords"),
+        # Batch writes read back the rows they stamped with their token
+        IndexModel([("batch_op", ASCENDING)], sparse=True, name="batch_op"),
+    ],
+    "favorites": [
+        IndexModel([("user_id", ASCENDING), ("product_id", ASCENDING)], unique=True, name="user_product_unique"),
+        IndexModel([("product_id", ASCENDING)], name="product"),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="user_timeline"),
+    ],
+    "messages": [
+        IndexModel([("sender_id", ASCENDING), ("timestamp", DESCENDING)], name="sender_timeline"),
+        IndexModel([("recipient_id", ASCENDING), ("timestamp", DESCENDING)], name="recipient_timeline"),
+        IndexModel(
+            [("product_id", ASCENDING), ("sender_id", ASCENDING), ("recipient_id", ASCENDING), ("timestamp", ASCENDING)],
+            name="thread",
+        ),
+    ],
+    "images": [
+        IndexModel([("key", ASCENDING)], unique=True, name="key_unique"),
+        IndexModel([("refs", ASCENDING), ("updated_at", ASCENDING)], name="gc"),
+    ],
+    "response_cache": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expiry"),
+        IndexModel([("tags", ASCENDING)], name="tags"),
+    ],
+    "conversations": [
+        IndexModel([("key", ASCENDING)], unique=True, name="key_unique"),
+        IndexModel(
+            [("participants", ASCENDING), ("updated_at", DESCENDING), ("key", DESCENDING)],
+            name="inbox",
+        ),
+        IndexModel([("product_id", ASCENDING)], name="product"),
+    ],
+}
+
+async def ensure_indexes():
+    """Create any missing indexes declared in INDEXES"""
+    for collection_name, indexes in INDEXES.items():
+        try:
+            created = await db[collection_name].create_indexes(indexes)
+            logging.info(f"Indexes ready on {collection_name}: {', '.join(created)}")
+        except OperationFailure as e:
+            # Conflicting definitions or duplicate data must be fixed by hand;
+            # the API still works without the index, just slower.
+            logging.error(f"Failed to create indexes on {collection_name}: {e}")
+
 # JWT and Password Configuration
 SECRET_KEY = os.environ.get("SECRET_KEY", "your-secret-key-here")
 ALGORITHM = "HS256"
@@ -32,19 +239,85 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+class FastJSONResponse(ORJSONResponse):
+    """orjson-encoded JSON response.
+    
+    Handlers on hot paths return it directly (see json_response) so FastAPI
+    skips its jsonable_encoder pass; orjson encodes datetimes natively.
+    """
+
+    def render(self, content) -> bytes:
+        with timed_section("serialize"):
+            return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+def json_response(content, status_code: int = 200, headers: Optional[dict] = None) -> FastJSONResponse:
+    return FastJSONResponse(content, status_code=status_code, headers=headers)
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Create uploads directory if it doesn't exist
+# Create uploads directory if it doesn't exist (served by serve_upload below)
 uploads_dir = ROOT_DIR / "uploads"
 uploads_dir.mkdir(exist_ok=True)
 
-# Serve static files
-app.mount("/uploads", StaticFiles(directory=str(uploads_dir)), name="uploads")
+# Metrics
+class Metrics:
+    """In-process counters and timing summaries, rendered in Prometheus text format"""
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.summaries = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def set(self, name: str, value: float, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        summary = self.summaries.setdefault(self._key(name, labels), [0, 0.0])
+        summary[0] += 1
+        summary[1] += value
+
+    @staticmethod
+    def _format(name: str, labels: tuple, value: float) -> str:
+        if labels:
+            rendered = ",".join(f'{k}="{v}"' for k, v in labels)
+            return f"{name}{{{rendered}}} {value}"
+        return f"{name} {value}"
+
+    def render(self) -> str:
+        lines = []
+        seen_types = set()
+
+        def declare(name, kind):
+            if name not in seen_types:
+                seen_types.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, "counter")
+            lines.append(self._format(name, labels, value))
+        for (name, labels), value in sorted(self.gauges.items()):
+            declare(name, "gauge")
+            lines.append(self._format(name, labels, value))
+        for (name, labels), (count, total) in sorted(self.summaries.items()):
+            declare(name, "summary")
+            lines.append(self._format(f"{name}_count", labels, count))
+            lines.append(self._format(f"{name}_sum", labels, total))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
 
 # Pydantic Models
 class UserCreate(BaseModel):
@@ -65,10 +338,12 @@ class User(BaseModel):
     avatar: Optional[str] = None
     location: Optional[str] = None
     joined_date: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
     is_verified: bool = False
     rating: float = 0.0
     total_sales: int = 0
     total_purchases: int = 0
+    version: int = 1
 
 class ProductCreate(BaseModel):
     title: str
@@ -93,7 +368,9 @@ class Product(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
     views: int = 0
+    favorite_count: int = 0
     is_sold: bool = False
+    version: int = 1
 
 class Message(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -122,6 +399,52 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+# bcrypt is deliberately slow, so hashing runs on a bounded thread pool instead
+# of the event loop. Once PASSWORD_QUEUE_LIMIT jobs are waiting or running,
+# new requests are rejected with 429 rather than queueing without bound.
+PASSWORD_POOL_SIZE = int(os.environ.get("PASSWORD_POOL_SIZE", "4"))
+PASSWORD_QUEUE_LIMIT = int(os.environ.get("PASSWORD_QUEUE_LIMIT", "64"))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_POOL_SIZE, thread_name_prefix="password")
+password_jobs_in_flight = 0
+
+async def run_password_job(job: str, func, *args):
+    """Run a password hashing function on the password pool, applying backpressure"""
+    global password_jobs_in_flight
+    if password_jobs_in_flight >= PASSWORD_QUEUE_LIMIT:
+        metrics.inc("password_jobs_rejected_total", job=job)
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many authentication requests, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+    
+    def timed_call():
+        started = time.perf_counter()
+        result = func(*args)
+        return started, result, time.perf_counter()
+    
+    password_jobs_in_flight += 1
+    metrics.set("password_jobs_in_flight", password_jobs_in_flight)
+    submitted = time.perf_counter()
+    try:
+        started, result, finished = await asyncio.get_running_loop().run_in_executor(password_executor, timed_call)
+    finally:
+        password_jobs_in_flight -= 1
+        metrics.set("password_jobs_in_flight", password_jobs_in_flight)
+    
+    metrics.observe("password_pool_wait_seconds", started - submitted, job=job)
+    metrics.observe("password_compute_seconds", finished - started, job=job)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.add_section(func.__name__, finished - started)
+    return result
+
+async def hash_password(password: str) -> str:
+    return await run_password_job("hash", get_password_hash, password)
+
+async def check_password(plain_password: str, hashed_password: str) -> bool:
+    return await run_password_job("verify", verify_password, plain_password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -132,44 +455,1145 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+# Optional claims embedded in access tokens so routes that only need the
+# caller's identity can skip the users lookup entirely
+JWT_EMBED_CLAIMS = os.environ.get("JWT_EMBED_CLAIMS", "false").lower() in ("1", "true", "yes")
+EMBEDDED_AVATAR_MAX_LENGTH = 512
+
+def token_claims(user: dict) -> dict:
+    """Claims placed in a user's access token"""
+    claims = {"sub": user["id"]}
+    if JWT_EMBED_CLAIMS:
+        avatar = user.get("avatar")
+        claims.update({
+            "name": user["name"],
+            # Inline (base64) avatars are too large to carry on every request
+            "avatar": avatar if avatar and len(avatar) <= EMBEDDED_AVATAR_MAX_LENGTH else None,
+            "is_verified": user.get("is_verified", False),
+        })
+    return claims
+
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+def decode_access_token(token: str) -> dict:
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         raise credentials_exception
+    if payload.get("sub") is None:
+        raise credentials_exception
+    return payload
+
+async def load_user(user_id: str) -> Optional[dict]:
+    """Fetch a user document through the short-lived user cache"""
+    user = user_cache.get(user_id)
+    if user is not None:
+        metrics.inc("user_cache_requests_total", result="hit")
+        return user
     
+    metrics.inc("user_cache_requests_total", result="miss")
     user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    if user is not None:
+        user_cache.set(user_id, user)
+    return user
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = decode_access_token(credentials.credentials)
+    user = await load_user(payload["sub"])
     if user is None:
         raise credentials_exception
     return user
 
-def save_uploaded_image(image_data: str) -> str:
-    """Save base64 image data to uploads directory"""
+async def get_current_user_claims(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Identity of the caller; served from token claims when they are embedded"""
+    payload = decode_access_token(credentials.credentials)
+    if "name" in payload:
+        metrics.inc("user_cache_requests_total", result="claims")
+        return {
+            "id": payload["sub"],
+            "name": payload["name"],
+            "avatar": payload.get("avatar"),
+            "is_verified": payload.get("is_verified", False),
+        }
+    user = await load_user(payload["sub"])
+    if user is None:
+        raise credentials_exception
+    return user
+
+# Image storage
+# Images are content-addressed: the storage key is the SHA-256 of the bytes
+# plus the sniffed extension, so identical uploads share one blob. The
+# `images` collection holds a reference count per key, incremented when a
+# product is created and decremented when it is deleted; `python server.py
+# gc-images` removes blobs (and their variants) nobody references anymore.
+#
+# GC and uploads of the same bytes coordinate through a lease on the images
+# row: gc-images sets `deleting_until`, deletes the blobs while the lease is
+# comfortably valid, and only then drops the row. register_image waits while
+# a lease is held and, once the row is gone or the lease has lapsed, tells the
+# caller to write the blob again rather than trust that it still exists.
+IMAGE_STORE = os.environ.get("IMAGE_STORE", "local")
+IMAGE_GC_GRACE_SECONDS = int(os.environ.get("IMAGE_GC_GRACE_SECONDS", "3600"))
+IMAGE_GC_LEASE_SECONDS = float(os.environ.get("IMAGE_GC_LEASE_SECONDS", "60"))
+# GC stops deleting this long before its lease lapses, leaving room for a delete call in flight
+IMAGE_GC_LEASE_MARGIN_SECONDS = IMAGE_GC_LEASE_SECONDS / 4
+IMAGE_GC_POLL_SECONDS = 0.5
+IMAGE_CONTENT_TYPES = {".jpg": "image/jpeg", ".png": "image/png", ".gif": "image/gif", ".webp": "image/webp"}
+
+# Partially received uploads are staged here before being stored
+upload_tmp_dir = uploads_dir / ".tmp"
+upload_tmp_dir.mkdir(exist_ok=True)
+
+class LocalImageStore:
+    """Image blobs stored as files under the uploads directory"""
+
+    def __init__(self, root: Path, base_url: str = "/uploads"):
+        self.root = root
+        self.base_url = base_url
+
+    def path_for(self, key: str) -> Path:
+        return self.root / key
+
+    def url_for(self, key: str) -> str:
+        return f"{self.base_url}/{key}"
+
+    def exists(self, key: str) -> bool:
+        return self.path_for(key).exists()
+
+    def put_file(self, source: Path, key: str):
+        destination = self.path_for(key)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(source, destination)
+
+    def delete(self, key: str):
+        self.path_for(key).unlink(missing_ok=True)
+
+    def local_copy(self, key: str, directory: Path) -> Path:
+        """A readable local path for key; blobs are already local files"""
+        return self.path_for(key)
+
+class S3ImageStore:
+    """Image blobs stored in an S3-compatible bucket (AWS, MinIO, ...)"""
+
+    def __init__(self, bucket: str, public_url: str, endpoint_url: Optional[str] = None, prefix: str = ""):
+        import boto3
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/")
+        self.prefix = prefix
+
+    def url_for(self, key: str) -> str:
+        return f"{self.public_url}/{self.prefix}{key}"
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def put_file(self, source: Path, key: str):
+        self.client.upload_file(
+            str(source), self.bucket, self.prefix + key,
+            ExtraArgs={
+                "ContentType": IMAGE_CONTENT_TYPES.get(Path(key).suffix, "application/octet-stream"),
+                # Keys are content hashes, so objects never change
+                "CacheControl": "public, max-age=31536000, immutable",
+            }
+        )
+        source.unlink(missing_ok=True)
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def local_copy(self, key: str, directory: Path) -> Path:
+        """Download key into directory (blocking; call it off the event loop)"""
+        destination = directory / Path(key).name
+        self.client.download_file(self.bucket, self.prefix + key, str(destination))
+        return destination
+
+def create_image_store():
+    if IMAGE_STORE == "s3":
+        return S3ImageStore(
+            bucket=os.environ["S3_BUCKET"],
+            public_url=os.environ["S3_PUBLIC_URL"],
+            endpoint_url=os.environ.get("S3_ENDPOINT_URL"),
+            prefix=os.environ.get("S3_PREFIX", ""),
+        )
+    return LocalImageStore(uploads_dir)
+
+image_store = create_image_store()
+
+def store_blob(source: Path, key: str, overwrite: bool = False):
+    """Move a staged file into the store unless an identical blob is already there"""
+    if not overwrite and image_store.exists(key):
+        source.unlink(missing_ok=True)
+    else:
+        image_store.put_file(source, key)
+
+async def register_image(key: str, size: int) -> bool:
+    """Record a blob before it is stored; it stays unreferenced (and collectable) until a product uses it.
+    
+    Returns True when the blob has to be written even if the store reports it
+    exists: the row is new, or it was taken over from a lapsed GC lease.
+    """
+    while True:
+        now = datetime.utcnow()
+        try:
+            # deleting_until: None matches rows without a GC lease (and inserts one otherwise)
+            existing = await db.images.find_one_and_update(
+                {"key": key, "deleting_until": None},
+                {"$set": {"updated_at": now}, "$setOnInsert": {"refs": 0, "size": size, "created_at": now}},
+                projection={"_id": 0, "key": 1},
+                upsert=True
+            )
+            return existing is None
+        except DuplicateKeyError:
+            pass
+        
+        # gc-images holds a lease on this key; take the row over once the lease lapses
+        lapsed = await db.images.find_one_and_update(
+            {"key": key, "deleting_until": {"$lt": now}},
+            {"$set": {"updated_at": now}, "$unset": {"deleting_until": "", "variants": ""}},
+            projection={"_id": 0, "key": 1}
+        )
+        if lapsed is not None:
+            return True
+        await asyncio.sleep(IMAGE_GC_POLL_SECONDS)
+
+async def adjust_image_refs(keys: List[str], delta: int):
+    """Add delta to the reference count of every key (once per occurrence)"""
+    if not keys:
+        return
+    now = datetime.utcnow()
+    await db.images.bulk_write(
+        [UpdateOne({"key": key}, {"$inc": {"refs": delta}, "$set": {"updated_at": now}}) for key in keys],
+        ordered=False
+    )
+
+# Image uploads
+# Multipart bodies are size-checked while they stream in (see
+# UploadSizeLimitMiddleware) and each part is copied to disk in chunks off the
+# event loop, so memory per upload stays bounded regardless of image size.
+MAX_IMAGES_PER_PRODUCT = 5
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+MAX_UPLOAD_REQUEST_BYTES = int(os.environ.get(
+    "MAX_UPLOAD_REQUEST_BYTES", str(MAX_IMAGES_PER_PRODUCT * MAX_IMAGE_BYTES + 1024 * 1024)
+))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+]
+
+def sniff_image_extension(head: bytes) -> Optional[str]:
+    """File extension for the image format identified by its leading bytes"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    for signature, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return None
+
+def image_too_large() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Images must be at most {MAX_IMAGE_BYTES // (1024 * 1024)} MB"
+    )
+
+def save_uploaded_image(image_data: str) -> tuple:
+    """Stage base64 image data (legacy form-field uploads), returning (staged path, key, size)"""
+    # Remove data URL prefix if present
+    if image_data.startswith('data:image'):
+        image_data = image_data.split(',', 1)[1]
+    
+    if len(image_data) > (MAX_IMAGE_BYTES + 2) // 3 * 4:
+        raise image_too_large()
+    
+    try:
+        data = base64.b64decode(image_data)
+    except (binascii.Error, ValueError) as e:
+        logging.error(f"Error saving image: {e}")
+        raise HTTPException(status_code=400, detail="Invalid image data")
+    
+    extension = sniff_image_extension(data[:16])
+    if extension is None:
+        raise HTTPException(status_code=400, detail="Unsupported image type")
+    
+    key = f"{hashlib.sha256(data).hexdigest()}{extension}"
+    staged = upload_tmp_dir / f"{uuid.uuid4()}.part"
+    with open(staged, "wb") as f:
+        f.write(data)
+    return staged, key, len(data)
+
+def copy_upload_to_disk(source, destination: Path) -> tuple:
+    """Copy an uploaded file to destination in chunks, returning (extension, sha256, size)"""
+    head = source.read(16)
+    extension = sniff_image_extension(head)
+    if extension is None:
+        raise HTTPException(status_code=400, detail="Unsupported image type")
+    
+    digest = hashlib.sha256(head)
+    size = len(head)
+    try:
+        with open(destination, "wb") as out:
+            out.write(head)
+            while True:
+                chunk = source.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    raise image_too_large()
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        destination.unlink(missing_ok=True)
+        raise
+    return extension, digest.hexdigest(), size
+
+def stage_upload_file(source) -> tuple:
+    """Stage a multipart image part, returning (staged path, key, size)"""
+    staged = upload_tmp_dir / f"{uuid.uuid4()}.part"
+    extension, digest, size = copy_upload_to_disk(source, staged)
+    return staged, f"{digest}{extension}", size
+
+async def store_staged_image(staged: Path, key: str, size: int) -> str:
+    # Registering first refreshes updated_at and waits out any GC lease on the key
+    overwrite = await register_image(key, size)
+    with timed_section("store_blob"):
+        await run_in_threadpool(store_blob, staged, key, overwrite)
+    return key
+
+async def save_upload_file(upload: UploadFile) -> str:
+    """Stream a multipart image part into the image store, returning its key"""
+    with timed_section("stage_upload_file"):
+        staged = await run_in_threadpool(stage_upload_file, upload.file)
+    return await store_staged_image(*staged)
+
+async def save_base64_image(image_data: str) -> str:
+    with timed_section("save_uploaded_image"):
+        staged = await run_in_threadpool(save_uploaded_image, image_data)
+    return await store_staged_image(*staged)
+
+# Image variants
+# After a product is created its images are resized into WebP and JPEG
+# derivatives in a process pool and EXIF metadata is dropped. Variants are
+# stored next to their source blob and recorded on its `images` entry, so an
+# image that was already processed is never resized again. The pool is
+# started with the app and its workers are spawned rather than forked, since
+# forking a process that already runs threads (the event loop's thread pools,
+# Motor's monitors) can leave locks held in the child.
+IMAGE_VARIANT_SIZES = {"grid": 400, "detail": 1000, "full": 1600}
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "2"))
+image_executor = None
+
+def start_image_pool():
+    global image_executor
+    if image_executor is None and Image is not None:
+        image_executor = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+
+def stop_image_pool():
+    global image_executor
+    if image_executor is not None:
+        image_executor.shutdown(wait=True)
+        image_executor = None
+
+def generate_image_variants(source: str, output_dir: str, stem: str) -> dict:
+    """Resize one image into every variant size and format (runs in a worker process)"""
+    variants = {}
+    with Image.open(source) as original:
+        # Apply the EXIF orientation, then re-encode without any metadata
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        
+        for size_name, max_edge in IMAGE_VARIANT_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            webp_name = f"{stem}-{size_name}.webp"
+            jpeg_name = f"{stem}-{size_name}.jpg"
+            resized.save(Path(output_dir) / webp_name, "WEBP", quality=80, method=4)
+            resized.convert("RGB").save(
+                Path(output_dir) / jpeg_name, "JPEG", quality=82, optimize=True, progressive=True
+            )
+            variants[size_name] = {
+                "webp": webp_name,
+                "jpeg": jpeg_name,
+                "width": resized.width,
+                "height": resized.height,
+            }
+    return variants
+
+def store_variant_files(output_dir: str, variants: dict) -> dict:
+    """Move generated variant files into the store, returning their storage keys"""
+    stored = {}
+    for size_name, variant in variants.items():
+        stored[size_name] = dict(variant)
+        for image_format in ("webp", "jpeg"):
+            key = f"variants/{variant[image_format]}"
+            store_blob(Path(output_dir) / variant[image_format], key)
+            stored[size_name][image_format] = key
+    return stored
+
+async def image_variants_for(key: str) -> Optional[dict]:
+    """Variant keys for a stored image, generating them on first use"""
+    record = await db.images.find_one({"key": key}, {"_id": 0, "variants": 1})
+    if record and record.get("variants"):
+        return record["variants"]
+    if image_executor is None:
+        raise RuntimeError("Image pool is not running")
+    
+    loop = asyncio.get_running_loop()
+    output_dir = tempfile.mkdtemp(dir=upload_tmp_dir)
     try:
-        # Remove data URL prefix if present
-        if image_data.startswith('data:image'):
-            image_data = image_data.split(',')[1]
+        # S3 downloads block, so the copy is fetched on the threadpool into output_dir
+        source = await run_in_threadpool(image_store.local_copy, key, Path(output_dir))
+        generated = await loop.run_in_executor(
+            image_executor, generate_image_variants, str(source), output_dir, Path(key).stem
+        )
+        variants = await run_in_threadpool(store_variant_files, output_dir, generated)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    
+    await db.images.update_one({"key": key}, {"$set": {"variants": variants}})
+    return variants
+
+async def process_product_images(product_id: str, image_keys: List[str]):
+    """Generate variants for a product's images and record their URLs on the product"""
+    if Image is None or not image_keys:
+        return
+    
+    image_variants = []
+    for key in image_keys:
+        try:
+            variants = await image_variants_for(key)
+        except Exception as e:
+            logging.error(f"Error generating variants for {key}: {e}")
+            variants = None
+        image_variants.append({
+            size_name: {
+                **variant,
+                "webp": image_store.url_for(variant["webp"]),
+                "jpeg": image_store.url_for(variant["jpeg"]),
+            }
+            for size_name, variant in variants.items()
+        } if variants else None)
+    
+    update = {"image_variants": image_variants}
+    if image_variants[0]:
+        update["thumbnail"] = image_variants[0]["grid"]["webp"]
+    await db.products.update_one({"id": product_id}, {"$set": update})
+    await response_cache.invalidate("products", f"product:{product_id}")
+
+class UploadSizeLimitMiddleware:
+    """Reject multipart request bodies larger than max_bytes as they arrive"""
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
         
-        # Generate unique filename
-        filename = f"{uuid.uuid4()}.jpg"
-        filepath = uploads_dir / filename
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/form-data"):
+            return await self.app(scope, receive, send)
         
-        # Decode and save
-        with open(filepath, "wb") as f:
-            f.write(base64.b64decode(image_data))
+        too_large = HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Upload exceeds {self.max_bytes // (1024 * 1024)} MB"
+        )
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({"detail": too_large.detail}, status_code=too_large.status_code)
+            return await response(scope, receive, send)
         
-        return f"/uploads/{filename}"
-    except Exception as e:
-        logging.error(f"Error saving image: {e}")
-        raise HTTPException(status_code=400, detail="Invalid image data")
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Raised inside body parsing, so it surfaces as a normal 413 response
+                    raise too_large
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+# Per-route wall time, DB round trips, DB time and helper sections are exported
+# on /metrics and, unless SERVER_TIMING=0, as a Server-Timing response header.
+# Setting PROFILE_SLOW_REQUESTS_MS samples PROFILE_SAMPLE_RATE of requests with
+# pyinstrument and writes an HTML profile to PROFILE_DIR for each one slower
+# than the threshold.
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1") == "1"
+PROFILE_SLOW_REQUESTS_MS = float(os.environ.get("PROFILE_SLOW_REQUESTS_MS", "0"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.1"))
+PROFILE_DIR = Path(os.environ.get("PROFILE_DIR", str(ROOT_DIR / "profiles")))
+
+# With QUERY_DEBUG set, a request that makes more round trips than its route's
+# budget, or repeats one command shape more than QUERY_REPEAT_LIMIT times (the
+# signature of a per-row query loop), is logged (warn) or turned into a 500
+# whose exception propagates to the test client (raise). Budgets assume cold
+# caches, including the shared response cache read and write and, on
+# authenticated routes, the users lookup behind a user-cache miss.
+QUERY_BUDGET_DEFAULT = int(os.environ.get("QUERY_BUDGET_DEFAULT", "10"))
+QUERY_REPEAT_LIMIT = int(os.environ.get("QUERY_REPEAT_LIMIT", "2"))
+QUERY_AUTH_LOOKUP = 1
+QUERY_BUDGETS = {
+    "POST /api/auth/register": 2,
+    "POST /api/auth/login": 1,
+    "GET /api/auth/me": 1,
+    "GET /api/products": 6,
+    "GET /api/products/suggest": 1,
+    "GET /api/products/facets": 1,
+    "GET /api/products/{product_id}": 5,
+    "DELETE /api/products/{product_id}": QUERY_AUTH_LOOKUP + 6,
+    "GET /api/favorites": QUERY_AUTH_LOOKUP + 3,
+    "POST /api/favorites/{product_id}": QUERY_AUTH_LOOKUP + 3,
+    "DELETE /api/favorites/{product_id}": QUERY_AUTH_LOOKUP + 3,
+    "GET /api/messages": QUERY_AUTH_LOOKUP + 3,
+    "GET /api/messages/{conversation_id}": QUERY_AUTH_LOOKUP + 3,
+    "POST /api/messages": QUERY_AUTH_LOOKUP + 4,
+    "GET /api/users/{user_id}": 5,
+    "GET /api/users/{user_id}/products": 3,
+}
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised in QUERY_DEBUG=raise mode so test runs fail on query-count regressions"""
+
+def query_budget_violations(route_key: str, stats: RequestStats) -> List[str]:
+    problems = []
+    budget = QUERY_BUDGETS.get(route_key, QUERY_BUDGET_DEFAULT)
+    if stats.db_round_trips > budget:
+        problems.append(f"{stats.db_round_trips} round trips (budget {budget})")
+    for shape, count in stats.command_shapes.items():
+        if count > QUERY_REPEAT_LIMIT:
+            problems.append(f"{count}x {shape}")
+    return problems
+
+def server_timing_header(stats: RequestStats) -> str:
+    entries = [
+        f"app;dur={stats.elapsed() * 1000:.1f}",
+        f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.db_round_trips} round trips"',
+    ]
+    entries.extend(f"{name};dur={seconds * 1000:.1f}" for name, seconds in stats.sections.items())
+    return ", ".join(entries)
+
+class RequestProfilingMiddleware:
+    """Collect RequestStats for every HTTP request and report them per route"""
+
+    def __init__(self, app):
+        self.app = app
+        self.profiling = PROFILE_SLOW_REQUESTS_MS > 0 and Profiler is not None
+        if PROFILE_SLOW_REQUESTS_MS > 0 and Profiler is None:
+            logging.error("PROFILE_SLOW_REQUESTS_MS is set but pyinstrument is not installed")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        status_code = 500
+        # Taken when the last body chunk is sent: Starlette runs BackgroundTasks
+        # before self.app returns, and they are not part of the request's latency
+        finished = None
+        
+        async def timed_send(message):
+            nonlocal status_code, finished
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if QUERY_DEBUG != "off":
+                    self.check_query_budget(scope, stats)
+                if SERVER_TIMING:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing_header(stats).encode("latin-1")))
+                    message = dict(message, headers=headers)
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finished = (stats.elapsed(), stats.db_seconds, stats.db_round_trips, dict(stats.sections))
+        
+        profiler = None
+        if self.profiling and random.random() < PROFILE_SAMPLE_RATE:
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            request_stats.reset(token)
+            if finished is None:
+                finished = (stats.elapsed(), stats.db_seconds, stats.db_round_trips, dict(stats.sections))
+            elapsed, db_seconds, db_round_trips, sections = finished
+            # Label by route template so ids in the path don't explode cardinality
+            route = getattr(scope.get("route"), "path", "unmatched")
+            labels = {"route": route, "method": scope["method"]}
+            metrics.inc("http_requests_total", status=status_code, **labels)
+            metrics.observe("http_request_duration_seconds", elapsed, **labels)
+            metrics.observe("http_request_db_seconds", db_seconds, **labels)
+            metrics.observe("http_request_db_round_trips", db_round_trips, **labels)
+            for name, seconds in sections.items():
+                metrics.observe("http_request_section_seconds", seconds, section=name, **labels)
+            if profiler is not None:
+                profiler.stop()
+                if elapsed * 1000 >= PROFILE_SLOW_REQUESTS_MS:
+                    self.dump_profile(profiler, scope, elapsed)
+
+    @staticmethod
+    def check_query_budget(scope, stats: RequestStats):
+        route_key = f"{scope['method']} {getattr(scope.get('route'), 'path', 'unmatched')}"
+        problems = query_budget_violations(route_key, stats)
+        if not problems:
+            return
+        metrics.inc("query_budget_violations_total", route=route_key)
+        report = f"{route_key} ({scope['path']}): " + "; ".join(problems)
+        if QUERY_DEBUG == "raise":
+            raise QueryBudgetExceeded(report)
+        logging.warning(f"Query budget exceeded: {report}")
+
+    @staticmethod
+    def dump_profile(profiler, scope, elapsed: float):
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9]+", "-", scope["path"]).strip("-") or "root"
+        path = PROFILE_DIR / f"{datetime.utcnow():%Y%m%dT%H%M%S}-{scope['method']}-{slug[:80]}-{elapsed * 1000:.0f}ms.html"
+        try:
+            path.write_text(profiler.output_html())
+        except OSError as e:
+            logging.error(f"Error writing request profile: {e}")
+        else:
+            logging.warning(f"Slow request {scope['method']} {scope['path']} took {elapsed * 1000:.0f} ms, profile saved to {path}")
+
+# Public seller fields attached to product listings
+SELLER_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "name": 1,
+    "avatar": 1,
+    "is_verified": 1,
+    "rating": 1,
+    "total_sales": 1,
+    "version": 1,
+    "updated_at": 1,
+}
+
+async def fetch_by_ids(collection, ids, projection: dict) -> dict:
+    """Fetch documents for a set of ids in one round trip, keyed by id"""
+    unique_ids = list({i for i in ids if i})
+    if not unique_ids:
+        return {}
+    cursor = collection.find({"id": {"$in": unique_ids}}, projection)
+    docs = await cursor.to_list(length=len(unique_ids))
+    return {doc["id"]: doc for doc in docs}
+
+def seller_summary(seller: dict, include_member_since: bool = False) -> dict:
+    """Shape a user document into the public seller block"""
+    summary = {
+        "id": seller["id"],
+        "name": seller["name"],
+        "avatar": seller.get("avatar"),
+        "is_verified": seller.get("is_verified", False),
+        "rating": seller.get("rating", 0.0),
+        "total_sales": seller.get("total_sales", 0),
+        # Lets listings revalidate when the seller's name or avatar changes
+        "version": seller.get("version", 0),
+        "updated_at": seller.get("updated_at")
+    }
+    if include_member_since and seller.get("joined_date"):
+        summary["member_since"] = seller["joined_date"].strftime("%B %Y")
+    return summary
+
+async def attach_sellers(products: List[dict], include_member_since: bool = False) -> List[dict]:
+    """Attach the seller block to each product using a single batched users query"""
+    projection = dict(SELLER_PROJECTION)
+    if include_member_since:
+        projection["joined_date"] = 1
+    sellers = await fetch_by_ids(db.users, (p.get("seller_id") for p in products), projection)
+    for product in products:
+        seller = sellers.get(product.get("seller_id"))
+        if seller:
+            product["seller"] = seller_summary(seller, include_member_since)
+    return products
+
+# Caching and pagination helpers
+class TTLCache:
+    """Small in-process LRU cache whose entries expire after ttl seconds"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def peek(self, key, default=None):
+        """Like get, but without refreshing the entry's LRU position"""
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return default
+        return entry[1]
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+# Exact totals are expensive on large filters, so they are reused for a short while
+count_cache = TTLCache(maxsize=2048, ttl=30.0)
+
+# Authenticated requests look the caller up here first; update_user_profile evicts
+user_cache = TTLCache(
+    maxsize=int(os.environ.get("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("USER_CACHE_TTL", "30")),
+)
+
+async def cached_count(collection, query: dict) -> int:
+    """count_documents with a short-lived cache keyed by the normalized filter"""
+    key = (collection.name, json.dumps(query, sort_keys=True, default=str))
+    total = count_cache.get(key)
+    if total is None:
+        total = await collection.count_documents(query)
+        count_cache.set(key, total)
+    return total
+
+# Feeds are ordered newest first with id as a tie-breaker
+FEED_SORT = [("created_at", DESCENDING), ("id", DESCENDING)]
+
+def encode_cursor(created_at: datetime, item_id: str) -> str:
+    """Opaque keyset cursor pointing just past the given feed item"""
+    raw = json.dumps({"t": created_at.isoformat(), "id": item_id})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, time_field: str = "created_at", id_field: str = "id") -> dict:
+    """Turn a cursor back into a range predicate over (time_field, id_field)"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        created_at = datetime.fromisoformat(data["t"])
+        item_id = data["id"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {
+        "$or": [
+            {time_field: {"$lt": created_at}},
+            {time_field: created_at, id_field: {"$lt": item_id}}
+        ]
+    }
+
+async def paginate_feed(
+    query: dict,
+    projection: dict,
+    page: int,
+    limit: int,
+    cursor: Optional[str] = None,
+    include_total: bool = True,
+    sort: Optional[list] = None,
+) -> dict:
+    """Fetch one page of products using a keyset cursor when given, else page/skip"""
+    limit = max(1, min(limit, 100))
+    sort = sort or FEED_SORT
+    keyset = sort == FEED_SORT
+    
+    if cursor and not keyset:
+        raise HTTPException(status_code=400, detail="Cursor pagination is only available for newest-first ordering")
+    
+    if cursor:
+        find = db.products.find({**query, **decode_cursor(cursor)}, projection)
+    else:
+        find = db.products.find(query, projection).skip((max(page, 1) - 1) * limit)
+    products = await find.sort(sort).limit(limit).to_list(length=limit)
+    
+    next_cursor = None
+    if keyset and len(products) == limit:
+        last = products[-1]
+        next_cursor = encode_cursor(last["created_at"], last["id"])
+    
+    return {
+        "products": products,
+        "total": await cached_count(db.products, query) if include_total else None,
+        "page": page,
+        "limit": limit,
+        "next_cursor": next_cursor
+    }
+
+# Product view counting
+# Views are buffered in memory and written as one bulk_write every
+# VIEW_FLUSH_INTERVAL seconds or once VIEW_FLUSH_THRESHOLD views are pending.
+VIEW_FLUSH_INTERVAL = float(os.environ.get("VIEW_FLUSH_INTERVAL", "5"))
+VIEW_FLUSH_THRESHOLD = int(os.environ.get("VIEW_FLUSH_THRESHOLD", "500"))
+# Repeat views by the same viewer within this many seconds are ignored (0 disables)
+VIEW_DEDUP_WINDOW = float(os.environ.get("VIEW_DEDUP_WINDOW", "0"))
+
+class ViewCounter:
+    """Write-behind buffer of product view increments"""
+
+    def __init__(self, interval: float, threshold: int, dedup_window: float = 0):
+        self.interval = interval
+        self.threshold = threshold
+        self.pending = {}
+        self.pending_total = 0
+        self._seen = TTLCache(maxsize=100_000, ttl=dedup_window) if dedup_window > 0 else None
+        self._task = None
+        self._flushes = set()
+
+    def record(self, product_id: str, viewer: Optional[str] = None):
+        if self._seen is not None and viewer:
+            key = (product_id, viewer)
+            if self._seen.get(key):
+                return
+            self._seen.set(key, True)
+        
+        self.pending[product_id] = self.pending.get(product_id, 0) + 1
+        self.pending_total += 1
+        if self.pending_total >= self.threshold:
+            # Started in an empty context so the flush is not counted against
+            # the request whose view happened to cross the threshold
+            flush = contextvars.Context().run(asyncio.ensure_future, self.flush())
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        # Swap the buffer before awaiting so new views land in a fresh map
+        pending, self.pending, self.pending_total = self.pending, {}, 0
+        items = list(pending.items())
+        operations = [UpdateOne({"id": pid}, {"$inc": {"views": n}}) for pid, n in items]
+        try:
+            await db.products.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Unordered: everything not listed in writeErrors was applied
+            failed = [items[error["index"]] for error in e.details.get("writeErrors", [])]
+            logging.error(f"Error flushing product views: {len(failed)} of {len(items)} increments failed")
+            self._requeue(failed)
+        except Exception as e:
+            logging.error(f"Error flushing product views: {e}")
+            self._requeue(items)
+
+    def _requeue(self, items):
+        for pid, n in items:
+            self.pending[pid] = self.pending.get(pid, 0) + n
+            self.pending_total += n
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        await self.flush()
+
+view_counter = ViewCounter(VIEW_FLUSH_INTERVAL, VIEW_FLUSH_THRESHOLD, VIEW_DEDUP_WINDOW)
+
+# Response caching
+# Anonymous read endpoints cache their results per route and normalized
+# query string. Entries live in a per-process LRU and, with
+# RESPONSE_CACHE_SHARED enabled, in a `response_cache` collection shared by
+# all workers. Writes invalidate by tag (e.g. "products", "product:<id>",
+# "user:<id>"), and concurrent misses for one key share a single computation.
+# Invalidation reaches the shared tier and the local tier of the worker that
+# made the write; other workers' local entries can stay stale for up to
+# RESPONSE_CACHE_TTL, so keep the TTL short when running several workers.
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "15"))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "2048"))
+RESPONSE_CACHE_SHARED = os.environ.get("RESPONSE_CACHE_SHARED", "false").lower() in ("1", "true", "yes")
+
+class ResponseCache:
+    """Two-tier route result cache with tag invalidation and single-flight misses"""
+
+    def __init__(self, maxsize: int, ttl: float, shared=None):
+        self.ttl = ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.shared = shared
+        self.tags = defaultdict(set)
+        self.inflight = {}
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(route: str, params: dict) -> str:
+        normalized = sorted((k, str(v)) for k, v in params.items() if v is not None and v != "")
+        return f"{route}?{urlencode(normalized)}"
+
+    async def get_or_compute(self, route: str, params: dict, compute):
+        """Return the cached result for route+params, or await compute() -> (value, tags)"""
+        key = self.make_key(route, params)
+        value = self.local.get(key)
+        if value is not None:
+            metrics.inc("response_cache_requests_total", route=route, result="hit")
+            return value
+        
+        inflight = self.inflight.get(key)
+        if inflight is not None:
+            metrics.inc("response_cache_requests_total", route=route, result="coalesced")
+            return await asyncio.shield(inflight)
+        
+        future = asyncio.get_running_loop().create_future()
+        # Mark the exception as retrieved when nobody else was waiting
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.inflight[key] = future
+        invalidations_at_start = self.invalidations
+        try:
+            value, tags = await self._load_shared(key)
+            if value is not None:
+                metrics.inc("response_cache_requests_total", route=route, result="shared_hit")
+            else:
+                metrics.inc("response_cache_requests_total", route=route, result="miss")
+                value, tags = await compute()
+                # Don't keep a result computed across an invalidation; it may be stale
+                if self.invalidations == invalidations_at_start:
+                    await self._store_shared(key, value, tags)
+            if self.invalidations == invalidations_at_start:
+                self.local.set(key, value)
+                for tag in tags or ():
+                    self.tags[tag].add(key)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self.inflight.pop(key, None)
+
+    def peek(self, route: str, params: dict):
+        """The locally cached result, if any, without counting a lookup"""
+        return self.local.peek(self.make_key(route, params))
+
+    async def _load_shared(self, key: str) -> tuple:
+        """(value, tags) from the shared tier, or (None, None) on a miss"""
+        if self.shared is None:
+            return None, None
+        doc = await self.shared.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.utcnow()}}, {"value": 1, "tags": 1}
+        )
+        return (doc["value"], doc.get("tags")) if doc else (None, None)
+
+    async def _store_shared(self, key: str, value, tags):
+        if self.shared is None:
+            return
+        await self.shared.replace_one(
+            {"_id": key},
+            {"value": value, "tags": list(tags or ()), "expires_at": datetime.utcnow() + timedelta(seconds=self.ttl)},
+            upsert=True
+        )
+
+    async def invalidate(self, *tags: str):
+        """Drop entries with any of tags from the shared tier and this worker's local tier"""
+        self.invalidations += 1
+        for tag in tags:
+            for key in self.tags.pop(tag, ()):
+                self.local.pop(key)
+        if self.shared is not None:
+            await self.shared.delete_many({"tags": {"$in": list(tags)}})
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, db.response_cache if RESPONSE_CACHE_SHARED else None
+)
+
+# Conditional requests
+# Read endpoints send ETag/Last-Modified validators with Cache-Control:
+# no-cache, so browsers keep the body and revalidate with If-None-Match or
+# If-Modified-Since; a match is answered with an empty 304.
+def http_date(value: datetime) -> str:
+    return formatdate(value.replace(tzinfo=timezone.utc).timestamp(), usegmt=True)
+
+def version_etag(item_id: str, updated_at: datetime, version: int = 0, seller_version: Optional[int] = None) -> str:
+    """Strong ETag naming a document version; clients send it back in If-Match.
+    
+    Counters (views, favorite_count) do not bump the version, so they never change it.
+    """
+    stamp = int(updated_at.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    if seller_version is not None:
+        stamp = f"{stamp}-s{seller_version}"
+    return f'"{item_id}-{stamp}-v{version}"'
+
+def product_validators(product: dict) -> tuple:
+    """(ETag, Last-Modified) for a product with its seller block; seller edits count as changes"""
+    seller = product.get("seller") or {}
+    etag = version_etag(product["id"], product["updated_at"], product.get("version", 0), seller.get("version", 0))
+    return etag, max(product["updated_at"], seller.get("updated_at") or product["updated_at"])
+
+async def product_stamp(product_id: str) -> Optional[dict]:
+    """Just enough of a product and its seller for product_validators, in one round trip"""
+    pipeline = [
+        {"$match": {"id": product_id}},
+        {"$limit": 1},
+        {"$lookup": {"from": "users", "localField": "seller_id", "foreignField": "id", "as": "seller"}},
+        {"$project": {
+            "_id": 0, "id": 1, "updated_at": 1, "version": 1,
+            "seller": {
+                "version": {"$arrayElemAt": ["$seller.version", 0]},
+                "updated_at": {"$arrayElemAt": ["$seller.updated_at", 0]},
+            },
+        }},
+    ]
+    rows = await db.products.aggregate(pipeline).to_list(length=1)
+    return rows[0] if rows else None
+
+# If-Match names the version a client last read, either as an ETag from
+# version_etag or as a bare number; writes carrying one only apply to that
+# version and otherwise fail with 412, so lost updates are detected. If-Match
+# uses strong comparison, so weak (W/) tags never match.
+ETAG_VERSION = re.compile(r'-v(\d+)"\s*$|^"?(\d+)"?$')
+
+def if_match_version(request: Request) -> Optional[int]:
+    header = request.headers.get("if-match")
+    if header is None or header.strip() == "*":
+        return None
+    candidates = [tag.strip() for tag in header.split(",") if not tag.strip().startswith("W/")]
+    match = ETAG_VERSION.search(candidates[0]) if candidates else None
+    if not match:
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Unrecognized If-Match value")
+    return int(match.group(1) or match.group(2))
+
+def version_filter(version: Optional[int]) -> dict:
+    """Filter clause matching a document version (documents from before versioning count as 0)"""
+    if version is None:
+        return {}
+    return {"version": version} if version else {"version": {"$exists": False}}
+
+def version_conflict() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_412_PRECONDITION_FAILED,
+        detail="The resource was modified since you last read it"
+    )
+
+def result_set_etag(items: List[dict], *extra) -> str:
+    """Weak ETag for a list, hashed from each item's id, updated_at, seller version and favorite count"""
+    digest = hashlib.sha1()
+    for item in items:
+        seller_version = (item.get("seller") or {}).get("version")
+        # favorite_count changes without touching updated_at
+        digest.update(f"{item.get('id')}:{item.get('updated_at')}:{seller_version}:{item.get('favorite_count')};".encode())
+    digest.update(repr(extra).encode())
+    return f'W/"{digest.hexdigest()}"'
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime] = None) -> bool:
+    """Evaluate If-None-Match (weak comparison), falling back to If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in candidates or etag.removeprefix("W/") in candidates
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # HTTP dates have one-second resolution
+        return last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= since
+    return False
+
+def validator_headers(etag: str, last_modified: Optional[datetime] = None) -> dict:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+def is_conditional(request: Request) -> bool:
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+# Product search
+# Fields never sent to clients
+PRODUCT_PROJECTION = {"_id": 0, "keywords": 0, "image_keys": 0, "batch_op": 0, "deleting_until": 0}
+
+# Fields rendered by product cards in feeds and lists
+PRODUCT_CARD_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "title": 1,
+    "price": 1,
+    "images": {"$slice": 1},
+    "thumbnail": 1,
+    "category": 1,
+    "condition": 1,
+    "location": 1,
+    "seller_id": 1,
+    "is_sold": 1,
+    "favorite_count": 1,
+    "created_at": 1,
+    "updated_at": 1,
+}
+
+def build_keywords(title: str, description: str, tags: List[str]) -> List[str]:
+    """Normalized search tokens stored on each product for prefix (type-ahead) lookups"""
+    text = " ".join([title or "", description or "", " ".join(tags or [])])
+    return sorted(set(re.findall(r"\w+", text.lower())))
+
+def build_product_query(
+    category: Optional[str] = None,
+    location: Optional[str] = None,
+    price_min: Optional[float] = None,
+    price_max: Optional[float] = None,
+    search: Optional[str] = None,
+) -> dict:
+    """Build the products filter shared by the feed and its helpers"""
+    query = {"is_sold": False}
+    
+    if category and category != "all":
+        query["category"] = category
+    
+    if location:
+        # Escape user input so metacharacters are matched literally
+        query["location"] = {"$regex": re.escape(location), "$options": "i"}
+    
+    if price_min is not None or price_max is not None:
+        price_query = {}
+        if price_min is not None:
+            price_query["$gte"] = price_min
+        if price_max is not None:
+            price_query["$lte"] = price_max
+        query["price"] = price_query
+    
+    if search and search.strip():
+        query["$text"] = {"$search": search.strip()}
+    
+    return query
 
 # Authentication Routes
 @api_router.post("/auth/register", response_model=Token)
@@ -180,7 +1604,7 @@ async def register(user_data: UserCreate):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await hash_password(user_data.password)
     user = User(
         name=user_data.name,
         email=user_data.email,
@@ -195,7 +1619,7 @@ async def register(user_data: UserCreate):
     # Create access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.id}, expires_delta=access_token_expires
+        data=token_claims(user.dict()), expires_delta=access_token_expires
     )
     
     return {
@@ -207,12 +1631,12 @@ async def register(user_data: UserCreate):
 @api_router.post("/auth/login", response_model=Token)
 async def login(login_data: UserLogin):
     user = await db.users.find_one({"email": login_data.email}, {"_id": 0})
-    if not user or not verify_password(login_data.password, user["password_hash"]):
+    if not user or not await check_password(login_data.password, user["password_hash"]):
         raise HTTPException(status_code=400, detail="Incorrect email or password")
     
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user["id"]}, expires_delta=access_token_expires
+        data=token_claims(user), expires_delta=access_token_expires
     )
     
     # Remove password hash from response
@@ -231,95 +1655,193 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
 # Product Routes
 @api_router.get("/products")
 async def get_products(
+    request: Request,
     category: Optional[str] = None,
     location: Optional[str] = None,
     price_min: Optional[float] = None,
     price_max: Optional[float] = None,
     search: Optional[str] = None,
+    sort: Optional[str] = None,
     page: int = 1,
-    limit: int = 20
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    include_total: bool = True,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
 ):
-    # Build query
-    query = {"is_sold": False}
+    params = {
+        "category": category, "location": location, "price_min": price_min, "price_max": price_max,
+        "search": search, "sort": sort, "page": page, "limit": limit, "cursor": cursor,
+        "include_total": include_total
+    }
     
-    if category and category != "all":
-        query["category"] = category
+    async def compute():
+        # Build query
+        query = build_product_query(category, location, price_min, price_max, search)
+        
+        # Rank text matches by relevance unless the caller asks for newest first
+        order = sort
+        if order is None:
+            order = "relevance" if "$text" in query and not cursor else "newest"
+        if order == "relevance" and "$text" in query:
+            sort_spec = [("score", {"$meta": "textScore"}), ("created_at", DESCENDING)]
+        else:
+            sort_spec = FEED_SORT
+        
+        # Get products with pagination
+        result = await paginate_feed(query, PRODUCT_CARD_PROJECTION, page, limit, cursor, include_total, sort_spec)
+        
+        # Get seller info for all products in one query
+        await attach_sellers(result["products"])
+        
+        tags = ["products", *{f"user:{p['seller_id']}" for p in result["products"]}]
+        return result, tags
     
-    if location:
-        query["location"] = {"$regex": location, "$options": "i"}
+    result = await response_cache.get_or_compute("GET /api/products", params, compute)
     
-    if price_min is not None or price_max is not None:
-        price_query = {}
-        if price_min is not None:
-            price_query["$gte"] = price_min
-        if price_max is not None:
-            price_query["$lte"] = price_max
-        query["price"] = price_query
+    products = result["products"]
+    last_modified = max(
+        (stamp for p in products for stamp in (p.get("updated_at"), (p.get("seller") or {}).get("updated_at")) if stamp),
+        default=None
+    )
+    user_id = viewer_id(credentials)
+    if user_id is None:
+        etag = result_set_etag(products, result["total"], result["next_cursor"])
+    else:
+        # Hearts are per user, so they are added to copies after the shared cache
+        favorited = await favorited_product_ids(user_id, [p["id"] for p in products])
+        products = [dict(p, is_favorited=p["id"] in favorited) for p in products]
+        result = dict(result, products=products)
+        etag = result_set_etag(products, result["total"], result["next_cursor"], *sorted(favorited))
+        # A favorite toggle changes the body but not updated_at
+        last_modified = None
     
-    if search:
-        query["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"tags": {"$in": [search]}}
-        ]
+    headers = validator_headers(etag, last_modified)
+    headers["Vary"] = "Authorization"
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return json_response(result, headers=headers)
+
+@api_router.get("/products/suggest")
+async def suggest_products(q: str, limit: int = 8):
+    """Type-ahead suggestions: earlier words must match exactly, the last one as a prefix"""
+    tokens = re.findall(r"\w+", q.lower())
+    if not tokens:
+        return []
     
-    # Get total count
-    total = await db.products.count_documents(query)
+    *complete, partial = tokens
+    conditions = [{"keywords": {"$regex": f"^{re.escape(partial)}"}}]
+    if complete:
+        conditions.append({"keywords": {"$all": complete}})
     
-    # Get products with pagination
-    skip = (page - 1) * limit
-    cursor = db.products.find(query).skip(skip).limit(limit).sort("created_at", -1)
-    products = await cursor.to_list(length=limit)
+    limit = max(1, min(limit, 20))
+    # No sort: the first matches in keywords index order come back without
+    # scanning every listing that shares a short prefix
+    cursor = db.products.find(
+        {"is_sold": False, "$and": conditions},
+        {"_id": 0, "id": 1, "title": 1, "price": 1, "images": {"$slice": 1}}
+    ).limit(limit)
+    return json_response(await cursor.to_list(length=limit))
+
+# Facet counts for the sidebar, from one $facet aggregation. Counts are
+# disjunctive: each facet ignores its own filter, so picking a category still
+# shows how many listings the other categories have. Results are cached for
+# FACET_CACHE_TTL seconds per normalized filter.
+PRICE_BUCKETS = [0, 100, 500, 2000, 10000]
+FACET_LOCATION_LIMIT = 20
+facet_cache = TTLCache(maxsize=1024, ttl=float(os.environ.get("FACET_CACHE_TTL", "60")))
+
+def facet_stage(match: dict, stages: List[dict]) -> List[dict]:
+    return ([{"$match": match}] if match else []) + stages
+
+async def compute_facets(query: dict) -> dict:
+    # $text has to be in the first $match, so it stays in the shared stage
+    shared = {k: v for k, v in query.items() if k in ("is_sold", "$text")}
+    filters = {k: v for k, v in query.items() if k not in shared}
     
-    # Get seller info for each product
-    for product in products:
-        seller = await db.users.find_one({"id": product["seller_id"]}, {"_id": 0})
-        if seller:
-            product["seller"] = {
-                "id": seller["id"],
-                "name": seller["name"],
-                "avatar": seller.get("avatar"),
-                "is_verified": seller.get("is_verified", False),
-                "rating": seller.get("rating", 0.0),
-                "total_sales": seller.get("total_sales", 0)
-            }
+    def excluding(field):
+        return {k: v for k, v in filters.items() if k != field}
     
+    pipeline = [
+        {"$match": shared},
+        {"$facet": {
+            "total": facet_stage(filters, [{"$count": "count"}]),
+            "category": facet_stage(excluding("category"), [{"$sortByCount": "$category"}]),
+            "condition": facet_stage(filters, [{"$sortByCount": "$condition"}]),
+            "location": facet_stage(
+                excluding("location"), [{"$sortByCount": "$location"}, {"$limit": FACET_LOCATION_LIMIT}]
+            ),
+            "price": facet_stage(excluding("price"), [
+                {"$bucket": {"groupBy": "$price", "boundaries": PRICE_BUCKETS + [float("inf")], "default": "other"}}
+            ]),
+        }}
+    ]
+    facets = (await db.products.aggregate(pipeline).to_list(length=1))[0]
+    
+    price_counts = {row["_id"]: row["count"] for row in facets["price"]}
     return {
-        "products": products,
-        "total": total,
-        "page": page,
-        "limit": limit
+        "total": facets["total"][0]["count"] if facets["total"] else 0,
+        **{
+            field: [{"value": row["_id"], "count": row["count"]} for row in facets[field] if row["_id"] is not None]
+            for field in ("category", "condition", "location")
+        },
+        "price": [
+            {"min": low, "max": high, "count": price_counts.get(low, 0)}
+            for low, high in zip(PRICE_BUCKETS, PRICE_BUCKETS[1:] + [None])
+        ],
     }
 
+@api_router.get("/products/facets")
+async def get_product_facets(
+    category: Optional[str] = None,
+    location: Optional[str] = None,
+    price_min: Optional[float] = None,
+    price_max: Optional[float] = None,
+    search: Optional[str] = None
+):
+    """Category, condition, location and price-range counts for the current filter"""
+    query = build_product_query(category, location, price_min, price_max, search)
+    key = json.dumps(query, sort_keys=True, default=str)
+    facets = facet_cache.get(key)
+    if facets is None:
+        facets = await compute_facets(query)
+        facet_cache.set(key, facets)
+    return json_response(facets)
+
 @api_router.get("/products/{product_id}")
-async def get_product(product_id: str):
-    product = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+async def get_product(product_id: str, request: Request):
+    async def compute():
+        product = await db.products.find_one({"id": product_id}, PRODUCT_PROJECTION)
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        
+        # Get seller info
+        await attach_sellers([product], include_member_since=True)
+        return product, [f"product:{product_id}", f"user:{product['seller_id']}"]
     
-    # Increment views
-    await db.products.update_one(
-        {"id": product_id},
-        {"$inc": {"views": 1}}
-    )
+    cache_params = {"id": product_id}
+    viewer = request.client.host if request.client else None
     
-    # Get seller info
-    seller = await db.users.find_one({"id": product["seller_id"]}, {"_id": 0})
-    if seller:
-        product["seller"] = {
-            "id": seller["id"],
-            "name": seller["name"],
-            "avatar": seller.get("avatar"),
-            "is_verified": seller.get("is_verified", False),
-            "rating": seller.get("rating", 0.0),
-            "total_sales": seller.get("total_sales", 0),
-            "member_since": seller["joined_date"].strftime("%B %Y")
-        }
+    # Revalidation only needs the product's and seller's stamps, from the cache or a tiny read
+    if is_conditional(request):
+        stamp = response_cache.peek("GET /api/products/{id}", cache_params) or await product_stamp(product_id)
+        if stamp:
+            etag, last_modified = product_validators(stamp)
+            if is_not_modified(request, etag, last_modified):
+                view_counter.record(product_id, viewer)
+                return Response(status_code=304, headers=validator_headers(etag, last_modified))
     
-    return product
+    # Copy so the cached document is never modified
+    product = dict(await response_cache.get_or_compute("GET /api/products/{id}", cache_params, compute))
+    
+    # Increment views (buffered and flushed in the background)
+    view_counter.record(product_id, viewer)
+    product["views"] = product.get("views", 0) + view_counter.pending.get(product_id, 0)
+    
+    return json_response(product, headers=validator_headers(*product_validators(product)))
 
 @api_router.post("/products")
 async def create_product(
+    background_tasks: BackgroundTasks,
     title: str = Form(...),
     description: str = Form(...),
     price: float = Form(...),
@@ -328,17 +1850,25 @@ async def create_product(
     location: str = Form(...),
     tags: str = Form(""),
     images: List[str] = Form([]),
-    current_user: dict = Depends(get_current_user)
+    image_files: List[UploadFile] = File([]),
+    current_user: dict = Depends(get_current_user_claims)
 ):
     # Process tags
     tag_list = [tag.strip() for tag in tags.split(",") if tag.strip()] if tags else []
     
-    # Process images (assuming they're base64 encoded)
-    image_urls = []
-    for image_data in images[:5]:  # Limit to 5 images
+    # Process images: streamed file parts first, then legacy base64 strings
+    image_keys = []
+    for upload in image_files:
+        if len(image_keys) >= MAX_IMAGES_PER_PRODUCT:
+            break
+        if upload.filename:
+            image_keys.append(await save_upload_file(upload))
+    for image_data in images:
+        if len(image_keys) >= MAX_IMAGES_PER_PRODUCT:
+            break
         if image_data:
-            image_url = save_uploaded_image(image_data)
-            image_urls.append(image_url)
+            image_keys.append(await save_base64_image(image_data))
+    image_urls = [image_store.url_for(key) for key in image_keys]
     
     # Create product
     product = Product(
@@ -353,40 +1883,116 @@ async def create_product(
         seller_id=current_user["id"]
     )
     
-    await db.products.insert_one(product.dict())
+    product_dict = product.dict()
+    product_dict["keywords"] = build_keywords(title, description, tag_list)
+    product_dict["image_keys"] = image_keys
+    await db.products.insert_one(product_dict)
+    await adjust_image_refs(image_keys, 1)
+    await response_cache.invalidate("products")
+    
+    # Thumbnails and WebP variants are generated after the response is sent
+    background_tasks.add_task(process_product_images, product.id, image_keys)
     return product
 
 # Favorites Routes
+# The same card fields as PRODUCT_CARD_PROJECTION, as an aggregation $project
+# over the product joined onto a favorite
+FAVORITE_CARD_FIELDS = {
+    field: {"$slice": [f"$product.{field}", rule["$slice"]]} if isinstance(rule, dict) else f"$product.{field}"
+    for field, rule in PRODUCT_CARD_PROJECTION.items()
+    if field != "_id"
+}
+
 @api_router.get("/favorites")
-async def get_user_favorites(current_user: dict = Depends(get_current_user)):
-    favorites = await db.favorites.find({"user_id": current_user["id"]}).to_list(100)
+async def get_user_favorites(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    include_total: bool = True,
+    current_user: dict = Depends(get_current_user_claims)
+):
+    """Favorited products, most recently saved first"""
+    limit = max(1, min(limit, 100))
+    match = {"user_id": current_user["id"]}
+    if cursor:
+        match.update(decode_cursor(cursor))
     
-    # Get product details for each favorite
-    favorite_products = []
-    for fav in favorites:
-        product = await db.products.find_one({"id": fav["product_id"]}, {"_id": 0})
-        if product:
-            favorite_products.append(product)
+    # One pipeline: page through the user's favorites on (created_at, id),
+    # then join each to its product card
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"created_at": -1, "id": -1}},
+        {"$limit": limit},
+        {"$lookup": {"from": "products", "localField": "product_id", "foreignField": "id", "as": "product"}},
+        {"$unwind": {"path": "$product", "preserveNullAndEmptyArrays": True}},
+        {"$project": {"_id": 0, "id": 1, "created_at": 1, "product": FAVORITE_CARD_FIELDS}},
+    ]
+    rows = await db.favorites.aggregate(pipeline).to_list(length=limit)
     
-    return favorite_products
+    # The cursor follows favorites, so a deleted product only shortens the page
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+    
+    products = []
+    for row in rows:
+        product = row.get("product")
+        if product and product.get("id"):
+            product["favorited_at"] = row["created_at"]
+            products.append(product)
+    await attach_sellers(products)
+    
+    return json_response({
+        "products": products,
+        "total": await db.favorites.count_documents({"user_id": current_user["id"]}) if include_total else None,
+        "limit": limit,
+        "next_cursor": next_cursor
+    })
+
+def viewer_id(credentials: Optional[HTTPAuthorizationCredentials]) -> Optional[str]:
+    """User id behind an optional bearer token; a missing or invalid token reads as anonymous"""
+    if credentials is None:
+        return None
+    try:
+        return decode_access_token(credentials.credentials)["sub"]
+    except HTTPException:
+        return None
+
+async def favorited_product_ids(user_id: str, product_ids: List[str]) -> set:
+    """Which of product_ids the user has favorited, in one query covered by user_product_unique"""
+    if not product_ids:
+        return set()
+    cursor = db.favorites.find(
+        {"user_id": user_id, "product_id": {"$in": product_ids}},
+        {"_id": 0, "product_id": 1}
+    )
+    return {fav["product_id"] for fav in await cursor.to_list(length=len(product_ids))}
 
 @api_router.post("/favorites/{product_id}")
-async def add_favorite(product_id: str, current_user: dict = Depends(get_current_user)):
-    # Check if already favorited
-    existing = await db.favorites.find_one({
-        "user_id": current_user["id"],
-        "product_id": product_id
-    }, {"_id": 0})
+async def add_favorite(product_id: str, current_user: dict = Depends(get_current_user_claims)):
+    # A single upsert against the unique (user_id, product_id) index: it only
+    # inserts when the pair is new, so concurrent requests cannot double up
+    favorite = Favorite(user_id=current_user["id"], product_id=product_id)
+    try:
+        result = await db.favorites.update_one(
+            {"user_id": favorite.user_id, "product_id": product_id},
+            {"$setOnInsert": favorite.dict()},
+            upsert=True
+        )
+        created = result.upserted_id is not None
+    except DuplicateKeyError:
+        # Another request inserted the same pair between our match and insert
+        created = False
     
-    if existing:
+    if not created:
         raise HTTPException(status_code=400, detail="Already favorited")
     
-    favorite = Favorite(user_id=current_user["id"], product_id=product_id)
-    await db.favorites.insert_one(favorite.dict())
+    await db.products.update_one({"id": product_id}, {"$inc": {"favorite_count": 1}})
+    # Cached cards and the product page show favorite_count
+    await response_cache.invalidate(f"product:{product_id}", "products")
     return {"message": "Added to favorites"}
 
 @api_router.delete("/favorites/{product_id}")
-async def remove_favorite(product_id: str, current_user: dict = Depends(get_current_user)):
+async def remove_favorite(product_id: str, current_user: dict = Depends(get_current_user_claims)):
     result = await db.favorites.delete_one({
         "user_id": current_user["id"],
         "product_id": product_id
@@ -395,62 +2001,215 @@ async def remove_favorite(product_id: str, current_user: dict = Depends(get_curr
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Favorite not found")
     
+    await db.products.update_one({"id": product_id}, {"$inc": {"favorite_count": -1}})
+    await response_cache.invalidate(f"product:{product_id}", "products")
     return {"message": "Removed from favorites"}
 
 # Message Routes
+# Each (user pair, product) thread has a denormalized document in
+# `conversations` holding the last message and per-participant unread
+# counters. send_message and get_conversation_messages keep it current;
+# `python server.py rebuild-conversations` regenerates it from `messages`.
+def conversation_key(user_a: str, user_b: str, product_id: str) -> str:
+    first, second = sorted([user_a, user_b])
+    return f"{first}_{second}_{product_id}"
+
+async def record_conversation_message(message: dict):
+    """Store the message as the conversation's latest and bump the recipient's unread counter"""
+    participants = sorted([message["sender_id"], message["recipient_id"]])
+    unread_field = f"unread.{message['recipient_id']}"
+    # Concurrent sends can land out of order, so the snapshot only moves forward
+    is_newer = {"$lte": ["$updated_at", message["timestamp"]]}
+    await db.conversations.update_one(
+        {"key": conversation_key(message["sender_id"], message["recipient_id"], message["product_id"])},
+        [{"$set": {
+            "participants": {"$ifNull": ["$participants", participants]},
+            "product_id": {"$ifNull": ["$product_id", message["product_id"]]},
+            "last_message": {"$cond": [is_newer, {"$literal": message}, "$last_message"]},
+            "updated_at": {"$max": ["$updated_at", message["timestamp"]]},
+            unread_field: {"$add": [{"$ifNull": [f"${unread_field}", 0]}, 1]},
+        }}],
+        upsert=True
+    )
+
+# Real-time delivery
+# New messages are pushed to connected clients over Server-Sent Events.
+# LocalBroker fans out inside one process; with MESSAGE_BROKER=mongo every
+# worker tails a change stream on `messages` (requires a replica set), so a
+# message sent through any worker reaches subscribers on all of them.
+MESSAGE_BROKER = os.environ.get("MESSAGE_BROKER", "local")
+SSE_HEARTBEAT_SECONDS = 15
+SUBSCRIBER_QUEUE_SIZE = 100
+
+class LocalBroker:
+    """In-process pub/sub hub keyed by user id"""
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers[user_id].add(queue)
+        metrics.set("message_stream_subscribers", sum(len(q) for q in self.subscribers.values()))
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user_id]
+        metrics.set("message_stream_subscribers", sum(len(q) for q in self.subscribers.values()))
+
+    def deliver(self, message: dict):
+        """Hand a message to every local subscriber of its sender or recipient"""
+        for user_id, other_user_id in (
+            (message["recipient_id"], message["sender_id"]),
+            (message["sender_id"], message["recipient_id"]),
+        ):
+            event = {
+                "type": "message",
+                "conversation_id": f"{other_user_id}_{message['product_id']}",
+                "message": message
+            }
+            for queue in self.subscribers.get(user_id, ()):
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    # A stalled client should not hold up everyone else
+                    metrics.inc("message_stream_dropped_total")
+            if message["sender_id"] == message["recipient_id"]:
+                break
+
+    async def publish(self, message: dict):
+        self.deliver(message)
+
+class MongoChangeStreamBroker(LocalBroker):
+    """Fans out through a change stream so every worker sees every insert"""
+
+    def __init__(self):
+        super().__init__()
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def publish(self, message: dict):
+        # Delivery happens when the insert comes back through the change stream
+        pass
+
+    async def _watch(self):
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        while True:
+            try:
+                async with db.messages.watch(pipeline) as stream:
+                    async for change in stream:
+                        message = change["fullDocument"]
+                        message.pop("_id", None)
+                        self.deliver(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Message change stream failed, retrying: {e}")
+                await asyncio.sleep(1)
+
+MESSAGE_BROKERS = {
+    "local": LocalBroker,
+    "mongo": MongoChangeStreamBroker,
+}
+message_broker = MESSAGE_BROKERS[MESSAGE_BROKER]()
+
+@api_router.get("/messages/stream")
+async def stream_messages(
+    request: Request,
+    token: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    """Server-Sent Events stream of new messages for the current user.
+    
+    Browsers' EventSource cannot set headers, so the JWT may also be passed
+    as the `token` query parameter.
+    """
+    raw_token = credentials.credentials if credentials else token
+    if not raw_token:
+        raise credentials_exception
+    user_id = decode_access_token(raw_token)["sub"]
+    
+    async def event_stream():
+        queue = message_broker.subscribe(user_id)
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {orjson.dumps(event, default=str).decode()}\n\n"
+        finally:
+            message_broker.unsubscribe(user_id, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @api_router.get("/messages")
-async def get_user_conversations(current_user: dict = Depends(get_current_user)):
+async def get_user_conversations(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user_claims)
+):
     """Get all conversations for the current user"""
     user_id = current_user["id"]
+    limit = max(1, min(limit, 100))
     
-    # Get all messages where user is sender or recipient
-    messages = await db.messages.find({
-        "$or": [
-            {"sender_id": user_id},
-            {"recipient_id": user_id}
-        ]
-    }).sort("timestamp", -1).to_list(1000)
+    query = {"participants": user_id}
+    if cursor:
+        query.update(decode_cursor(cursor, "updated_at", "key"))
+    conversations = await db.conversations.find(query, {"_id": 0}).sort(
+        [("updated_at", DESCENDING), ("key", DESCENDING)]
+    ).limit(limit).to_list(length=limit)
     
-    # Group messages by conversation (other user + product)
-    conversations = {}
-    for message in messages:
-        other_user_id = message["recipient_id"] if message["sender_id"] == user_id else message["sender_id"]
-        conversation_key = f"{other_user_id}_{message['product_id']}"
-        
-        if conversation_key not in conversations:
-            # Get other user info
-            other_user = await db.users.find_one({"id": other_user_id}, {"_id": 0})
-            # Get product info
-            product = await db.products.find_one({"id": message["product_id"]}, {"_id": 0})
-            
-            conversations[conversation_key] = {
-                "id": conversation_key,
-                "other_user": {
-                    "id": other_user["id"],
-                    "name": other_user["name"],
-                    "avatar": other_user.get("avatar")
-                } if other_user else None,
-                "product": {
-                    "id": product["id"],
-                    "title": product["title"],
-                    "images": product["images"]
-                } if product else None,
-                "last_message": message,
-                "unread_count": 0
-            }
-        else:
-            # Update last message if this one is more recent
-            if message["timestamp"] > conversations[conversation_key]["last_message"]["timestamp"]:
-                conversations[conversation_key]["last_message"] = message
-        
-        # Count unread messages
-        if message["recipient_id"] == user_id and not message["is_read"]:
-            conversations[conversation_key]["unread_count"] += 1
+    headers = {}
+    if len(conversations) == limit:
+        last = conversations[-1]
+        headers["X-Next-Cursor"] = encode_cursor(last["updated_at"], last["key"])
+    
+    # Load other users and products for the page in two queries
+    other_user_ids = [
+        next((p for p in c["participants"] if p != user_id), user_id) for c in conversations
+    ]
+    other_users = await fetch_by_ids(db.users, other_user_ids, {"_id": 0, "id": 1, "name": 1, "avatar": 1})
+    products = await fetch_by_ids(
+        db.products, (c["product_id"] for c in conversations), {"_id": 0, "id": 1, "title": 1, "images": 1}
+    )
     
-    return list(conversations.values())
+    return json_response([
+        {
+            "id": f"{other_user_id}_{conversation['product_id']}",
+            "other_user": other_users.get(other_user_id),
+            "product": products.get(conversation["product_id"]),
+            "last_message": conversation["last_message"],
+            "unread_count": conversation.get("unread", {}).get(user_id, 0)
+        }
+        for conversation, other_user_id in zip(conversations, other_user_ids)
+    ], headers=headers)
 
 @api_router.get("/messages/{conversation_id}")
-async def get_conversation_messages(conversation_id: str, current_user: dict = Depends(get_current_user)):
+async def get_conversation_messages(conversation_id: str, current_user: dict = Depends(get_current_user_claims)):
     """Get all messages in a conversation"""
     user_id = current_user["id"]
     
@@ -467,20 +2226,37 @@ async def get_conversation_messages(conversation_id: str, current_user: dict = D
             {"sender_id": user_id, "recipient_id": other_user_id},
             {"sender_id": other_user_id, "recipient_id": user_id}
         ]
-    }).sort("timestamp", 1).to_list(1000)
+    }, {"_id": 0}).sort("timestamp", 1).to_list(1000)
     
-    # Mark messages as read for the current user
-    await db.messages.update_many(
+    # Mark the messages being returned as read for the current user
+    unread_ids = [m["id"] for m in messages if m["recipient_id"] == user_id and not m.get("is_read")]
+    if not unread_ids:
+        return json_response(messages)
+    marked = await db.messages.update_many(
         {
             "product_id": product_id,
             "sender_id": other_user_id,
             "recipient_id": user_id,
+            "id": {"$in": unread_ids},
             "is_read": False
         },
         {"$set": {"is_read": True}}
     )
+    if marked.modified_count:
+        # Subtract what was marked instead of zeroing, so a message arriving
+        # meanwhile stays counted; last_message is only marked if it was returned
+        unread_field = f"unread.{user_id}"
+        await db.conversations.update_one(
+            {"key": conversation_key(user_id, other_user_id, product_id)},
+            [{"$set": {
+                unread_field: {"$subtract": [{"$ifNull": [f"${unread_field}", 0]}, marked.modified_count]},
+                "last_message.is_read": {"$or": [
+                    "$last_message.is_read", {"$in": ["$last_message.id", unread_ids]}
+                ]},
+            }}]
+        )
     
-    return messages
+    return json_response(messages)
 
 class MessageCreate(BaseModel):
     recipient_id: str
@@ -488,7 +2264,7 @@ class MessageCreate(BaseModel):
     content: str
 
 @api_router.post("/messages")
-async def send_message(message_data: MessageCreate, current_user: dict = Depends(get_current_user)):
+async def send_message(message_data: MessageCreate, current_user: dict = Depends(get_current_user_claims)):
     """Send a new message"""
     # Verify recipient exists
     recipient = await db.users.find_one({"id": message_data.recipient_id}, {"_id": 0})
@@ -508,31 +2284,55 @@ async def send_message(message_data: MessageCreate, current_user: dict = Depends
         content=message_data.content
     )
     
-    await db.messages.insert_one(message.dict())
+    message_dict = message.dict()
+    await db.messages.insert_one(dict(message_dict))
+    await record_conversation_message(message_dict)
+    await message_broker.publish(message_dict)
     return message
 
 # User Routes
 @api_router.get("/users/{user_id}")
-async def get_user_profile(user_id: str):
+async def get_user_profile(user_id: str, request: Request):
     """Get public user profile"""
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    async def compute():
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        # Remove sensitive information
+        public_profile = {
+            "id": user["id"],
+            "name": user["name"],
+            "avatar": user.get("avatar"),
+            "location": user.get("location"),
+            "joined_date": user["joined_date"],
+            "updated_at": user.get("updated_at", user["joined_date"]),
+            "is_verified": user.get("is_verified", False),
+            "rating": user.get("rating", 0.0),
+            "total_sales": user.get("total_sales", 0),
+            "member_since": user["joined_date"].strftime("%B %Y"),
+            "version": user.get("version", 0)
+        }
+        return public_profile, [f"user:{user_id}"]
     
-    # Remove sensitive information
-    public_profile = {
-        "id": user["id"],
-        "name": user["name"],
-        "avatar": user.get("avatar"),
-        "location": user.get("location"),
-        "joined_date": user["joined_date"],
-        "is_verified": user.get("is_verified", False),
-        "rating": user.get("rating", 0.0),
-        "total_sales": user.get("total_sales", 0),
-        "member_since": user["joined_date"].strftime("%B %Y")
-    }
+    cache_params = {"id": user_id}
+    if is_conditional(request):
+        stamp = response_cache.peek("GET /api/users/{id}", cache_params) or await db.users.find_one(
+            {"id": user_id}, {"_id": 0, "id": 1, "updated_at": 1, "joined_date": 1, "version": 1}
+        )
+        if stamp:
+            updated_at = stamp.get("updated_at") or stamp["joined_date"]
+            etag = version_etag(stamp["id"], updated_at, stamp.get("version", 0))
+            if is_not_modified(request, etag, updated_at):
+                return Response(status_code=304, headers=validator_headers(etag, updated_at))
     
-    return public_profile
+    profile = await response_cache.get_or_compute("GET /api/users/{id}", cache_params, compute)
+    return json_response(
+        profile,
+        headers=validator_headers(
+            version_etag(profile["id"], profile["updated_at"], profile.get("version", 0)), profile["updated_at"]
+        )
+    )
 
 class UserUpdate(BaseModel):
     name: Optional[str] = None
@@ -541,60 +2341,60 @@ class UserUpdate(BaseModel):
     avatar: Optional[str] = None
 
 @api_router.put("/users/{user_id}")
-async def update_user_profile(user_id: str, update_data: UserUpdate, current_user: dict = Depends(get_current_user)):
+async def update_user_profile(
+    user_id: str,
+    update_data: UserUpdate,
+    request: Request,
+    current_user: dict = Depends(get_current_user_claims)
+):
     """Update user profile (own profile only)"""
     if current_user["id"] != user_id:
         raise HTTPException(status_code=403, detail="Can only update own profile")
     
-    # Build update data
-    update_fields = {}
-    if update_data.name is not None:
-        update_fields["name"] = update_data.name
-    if update_data.phone is not None:
-        update_fields["phone"] = update_data.phone
-    if update_data.location is not None:
-        update_fields["location"] = update_data.location
-    if update_data.avatar is not None:
-        update_fields["avatar"] = update_data.avatar
-    
+    update_fields = update_data.dict(exclude_none=True)
     if not update_fields:
         raise HTTPException(status_code=400, detail="No valid fields to update")
     
-    # Update user
-    result = await db.users.update_one(
-        {"id": user_id},
-        {"$set": update_fields}
+    update_fields["updated_at"] = datetime.utcnow()
+    expected_version = if_match_version(request)
+    
+    # Update and read back in one round trip
+    updated_user = await db.users.find_one_and_update(
+        {"id": user_id, **version_filter(expected_version)},
+        {"$set": update_fields, "$inc": {"version": 1}},
+        projection={"_id": 0, "password_hash": 0},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
+    if updated_user is None:
+        if expected_version is not None and await db.users.find_one({"id": user_id}, {"_id": 0, "id": 1}):
+            raise version_conflict()
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Return updated user
-    updated_user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    return {k: v for k, v in updated_user.items() if k != "password_hash"}
+    # Drop cached copies so the next request sees the change
+    user_cache.pop(user_id)
+    await response_cache.invalidate(f"user:{user_id}")
+    
+    etag = version_etag(user_id, updated_user["updated_at"], updated_user["version"])
+    return json_response(updated_user, headers={"ETag": etag})
 
 @api_router.get("/users/{user_id}/products")
-async def get_user_products(user_id: str, page: int = 1, limit: int = 20):
+async def get_user_products(
+    user_id: str,
+    page: int = 1,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    include_total: bool = True
+):
     """Get user's active listings"""
     # Verify user exists
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "id": 1})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Get user's products
     query = {"seller_id": user_id, "is_sold": False}
-    total = await db.products.count_documents(query)
-    
-    skip = (page - 1) * limit
-    cursor = db.products.find(query).skip(skip).limit(limit).sort("created_at", -1)
-    products = await cursor.to_list(length=limit)
-    
-    return {
-        "products": products,
-        "total": total,
-        "page": page,
-        "limit": limit
-    }
+    return json_response(await paginate_feed(query, PRODUCT_CARD_PROJECTION, page, limit, cursor, include_total))
 
 # Product Management Routes
 class ProductUpdate(BaseModel):
@@ -607,90 +2407,397 @@ class ProductUpdate(BaseModel):
     tags: Optional[List[str]] = None
     is_sold: Optional[bool] = None
 
+SEARCHABLE_FIELDS = {"title", "description", "tags"}
+PRODUCT_UPDATE_ATTEMPTS = 3
+
+async def product_write_error(product_id: str, user_id: str) -> HTTPException:
+    """Explain why an ownership- and version-filtered write matched nothing"""
+    product = await db.products.find_one({"id": product_id}, {"_id": 0, "seller_id": 1})
+    if not product:
+        return HTTPException(status_code=404, detail="Product not found")
+    if product["seller_id"] != user_id:
+        return HTTPException(status_code=403, detail="Can only update own products")
+    return version_conflict()
+
 @api_router.put("/products/{product_id}")
-async def update_product(product_id: str, update_data: ProductUpdate, current_user: dict = Depends(get_current_user)):
+async def update_product(
+    product_id: str,
+    update_data: ProductUpdate,
+    request: Request,
+    current_user: dict = Depends(get_current_user_claims)
+):
     """Update product (owner only)"""
-    # Verify product exists and user is owner
-    product = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+    update_fields = update_data.dict(exclude_none=True)
+    expected_version = if_match_version(request)
+    # The ownership check is part of the update filter
+    owner_filter = {"id": product_id, "seller_id": current_user["id"]}
+    
+    if not update_fields:
+        product = await db.products.find_one({**owner_filter, **version_filter(expected_version)}, PRODUCT_PROJECTION)
+        if product is None:
+            raise await product_write_error(product_id, current_user["id"])
+        await attach_sellers([product], include_member_since=True)
+        return json_response(product, headers=validator_headers(*product_validators(product)))
     
-    if product["seller_id"] != current_user["id"]:
-        raise HTTPException(status_code=403, detail="Can only update own products")
-    
-    # Build update data
-    update_fields = {}
-    if update_data.title is not None:
-        update_fields["title"] = update_data.title
-    if update_data.description is not None:
-        update_fields["description"] = update_data.description
-    if update_data.price is not None:
-        update_fields["price"] = update_data.price
-    if update_data.category is not None:
-        update_fields["category"] = update_data.category
-    if update_data.condition is not None:
-        update_fields["condition"] = update_data.condition
-    if update_data.location is not None:
-        update_fields["location"] = update_data.location
-    if update_data.tags is not None:
-        update_fields["tags"] = update_data.tags
-    if update_data.is_sold is not None:
-        update_fields["is_sold"] = update_data.is_sold
-    
-    if update_fields:
-        update_fields["updated_at"] = datetime.utcnow()
+    for _ in range(PRODUCT_UPDATE_ATTEMPTS):
+        version = expected_version
+        fields = dict(update_fields, updated_at=datetime.utcnow())
         
-        result = await db.products.update_one(
-            {"id": product_id},
-            {"$set": update_fields}
-        )
+        # Search tokens also depend on the searchable fields the patch leaves
+        # alone, so read those first and only write if nobody changed them since
+        if SEARCHABLE_FIELDS & fields.keys():
+            current = await db.products.find_one(
+                {**owner_filter, **version_filter(version)},
+                {"_id": 0, "title": 1, "description": 1, "tags": 1, "version": 1}
+            )
+            if current is None:
+                raise await product_write_error(product_id, current_user["id"])
+            version = current.get("version", 0)
+            fields["keywords"] = build_keywords(
+                fields.get("title", current["title"]),
+                fields.get("description", current["description"]),
+                fields.get("tags", current.get("tags", []))
+            )
         
-        if result.matched_count == 0:
-            raise HTTPException(status_code=404, detail="Product not found")
+        product = await db.products.find_one_and_update(
+            {**owner_filter, **version_filter(version)},
+            {"$set": fields, "$inc": {"version": 1}},
+            projection=PRODUCT_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+        if product is not None:
+            break
+        if expected_version is not None or version is None:
+            raise await product_write_error(product_id, current_user["id"])
+        # A concurrent edit landed between our read and write; recompute from the new text
+    else:
+        raise version_conflict()
     
-    # Return updated product
-    updated_product = await db.products.find_one({"id": product_id})
-    return updated_product
+    await response_cache.invalidate("products", f"product:{product_id}")
+    # Same body and validators as GET /api/products/{id}, so the ETag can be revalidated
+    await attach_sellers([product], include_member_since=True)
+    return json_response(product, headers=validator_headers(*product_validators(product)))
+
+def not_being_deleted(now: datetime) -> dict:
+    """Filter clause excluding products under a live batch-delete lease"""
+    return {"$or": [{"deleting_until": None}, {"deleting_until": {"$lt": now}}]}
+
+async def delete_products_cascade(products: List[dict]):
+    """Remove everything hanging off deleted products: favorites, messages, conversations, image refs and cached reads"""
+    if not products:
+        return
+    product_ids = [product["id"] for product in products]
+    related = {"product_id": {"$in": product_ids}}
+    await asyncio.gather(
+        db.favorites.delete_many(related),
+        db.messages.delete_many(related),
+        db.conversations.delete_many(related),
+        adjust_image_refs([key for product in products for key in product.get("image_keys", [])], -1),
+    )
+    await response_cache.invalidate("products", *(f"product:{product_id}" for product_id in product_ids))
 
 @api_router.delete("/products/{product_id}")
-async def delete_product(product_id: str, current_user: dict = Depends(get_current_user)):
+async def delete_product(product_id: str, current_user: dict = Depends(get_current_user_claims)):
     """Delete product (owner only)"""
-    # Verify product exists and user is owner
-    product = await db.products.find_one({"id": product_id})
+    # The ownership check is part of the delete filter; rows a batch delete
+    # has marked are left to it so they are cascaded only once
+    product = await db.products.find_one_and_delete(
+        {"id": product_id, "seller_id": current_user["id"], **not_being_deleted(datetime.utcnow())},
+        projection={"_id": 0, "id": 1, "image_keys": 1}
+    )
     if not product:
+        # Only the failure path pays for telling 404 and 403 apart
+        existing = await db.products.find_one({"id": product_id}, {"_id": 0, "id": 1, "seller_id": 1})
+        if existing and existing["seller_id"] != current_user["id"]:
+            raise HTTPException(status_code=403, detail="Can only delete own products")
         raise HTTPException(status_code=404, detail="Product not found")
     
-    if product["seller_id"] != current_user["id"]:
-        raise HTTPException(status_code=403, detail="Can only delete own products")
+    await delete_products_cascade([product])
+    return {"message": "Product deleted successfully"}
+
+# Batch product management
+# Sellers can patch or delete up to MAX_BATCH_PRODUCTS listings per request.
+# Each batch is written with one ownership-filtered command that also stamps
+# the rows with a per-request `batch_op` token; reading the token back tells
+# exactly which products this request changed: updated / deleted, not_found,
+# forbidden, or conflict when a text patch raced another edit. Deletes first
+# mark their rows under a short `deleting_until` lease, read the image keys of
+# the marked rows, and then delete by token, so a product is cascaded once
+# even when batch and single deletes overlap.
+MAX_BATCH_PRODUCTS = int(os.environ.get("MAX_BATCH_PRODUCTS", "100"))
+BATCH_DELETE_LEASE_SECONDS = 60
+
+QUERY_BUDGETS.update({
+    "PATCH /api/products/batch": QUERY_AUTH_LOOKUP + 5,
+    "POST /api/products/batch/delete": QUERY_AUTH_LOOKUP + 8,
+})
+
+class ProductBatchUpdate(BaseModel):
+    ids: List[str]
+    patch: ProductUpdate
+
+class ProductBatchDelete(BaseModel):
+    ids: List[str]
+
+def batch_ids(ids: List[str]) -> List[str]:
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise HTTPException(status_code=400, detail="No product ids given")
+    if len(ids) > MAX_BATCH_PRODUCTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_PRODUCTS} products per batch")
+    return ids
+
+async def batch_miss_statuses(ids: List[str], seller_id: str, owned_status: str) -> dict:
+    """Explain why ownership-filtered writes matched nothing (only runs for misses)"""
+    found = await fetch_by_ids(db.products, ids, {"_id": 0, "id": 1, "seller_id": 1})
+    statuses = {}
+    for product_id in ids:
+        product = found.get(product_id)
+        if product is None:
+            statuses[product_id] = "not_found"
+        elif product["seller_id"] != seller_id:
+            statuses[product_id] = "forbidden"
+        else:
+            statuses[product_id] = owned_status
+    return statuses
+
+@api_router.patch("/products/batch")
+async def batch_update_products(batch: ProductBatchUpdate, current_user: dict = Depends(get_current_user_claims)):
+    """Apply one patch (e.g. mark sold, change price) to several of the caller's products"""
+    update_fields = batch.patch.dict(exclude_none=True)
+    if not update_fields:
+        raise HTTPException(status_code=400, detail="Empty patch")
+    ids = batch_ids(batch.ids)
+    seller_id = current_user["id"]
+    token = uuid.uuid4().hex
     
-    # Delete product
-    result = await db.products.delete_one({"id": product_id})
+    update_fields["updated_at"] = datetime.utcnow()
+    update_fields["batch_op"] = token
+    if SEARCHABLE_FIELDS & update_fields.keys():
+        # Search tokens depend on each product's own text: read it with its
+        # version and only write if nobody changed the product since
+        current = await fetch_by_ids(
+            db.products, ids, {"_id": 0, "id": 1, "seller_id": 1, "title": 1, "description": 1, "tags": 1, "version": 1}
+        )
+        operations = [
+            UpdateOne(
+                {"id": product["id"], "seller_id": seller_id, **version_filter(product.get("version", 0))},
+                {"$set": dict(update_fields, keywords=build_keywords(
+                    update_fields.get("title", product["title"]),
+                    update_fields.get("description", product["description"]),
+                    update_fields.get("tags", product.get("tags", []))
+                )), "$inc": {"version": 1}}
+            )
+            for product in current.values() if product["seller_id"] == seller_id
+        ]
+        if operations:
+            await db.products.bulk_write(operations, ordered=False)
+    else:
+        await db.products.update_many(
+            {"id": {"$in": ids}, "seller_id": seller_id},
+            {"$set": update_fields, "$inc": {"version": 1}}
+        )
     
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Product not found")
+    cursor = db.products.find({"batch_op": token}, {"_id": 0, "id": 1})
+    updated = {doc["id"] for doc in await cursor.to_list(length=len(ids))}
+    missed = [product_id for product_id in ids if product_id not in updated]
     
-    # Clean up related data
-    await db.favorites.delete_many({"product_id": product_id})
-    await db.messages.delete_many({"product_id": product_id})
+    results = {product_id: "updated" for product_id in updated}
+    if missed:
+        results.update(await batch_miss_statuses(missed, seller_id, owned_status="conflict"))
+    if updated:
+        await response_cache.invalidate("products", *(f"product:{product_id}" for product_id in updated))
     
-    return {"message": "Product deleted successfully"}
+    return {"results": [{"id": product_id, "status": results[product_id]} for product_id in ids]}
+
+@api_router.post("/products/batch/delete")
+async def batch_delete_products(batch: ProductBatchDelete, current_user: dict = Depends(get_current_user_claims)):
+    """Delete several of the caller's products"""
+    ids = batch_ids(batch.ids)
+    seller_id = current_user["id"]
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    
+    await db.products.update_many(
+        {"id": {"$in": ids}, "seller_id": seller_id, **not_being_deleted(now)},
+        {"$set": {"batch_op": token, "deleting_until": now + timedelta(seconds=BATCH_DELETE_LEASE_SECONDS)}}
+    )
+    cursor = db.products.find({"batch_op": token}, {"_id": 0, "id": 1, "image_keys": 1})
+    deleted_products = await cursor.to_list(length=len(ids))
+    await db.products.delete_many({"batch_op": token})
+    # Only what this request marked is cascaded, so image refs are released exactly once
+    await delete_products_cascade(deleted_products)
+    
+    results = {product["id"]: "deleted" for product in deleted_products}
+    missed = [product_id for product_id in ids if product_id not in results]
+    if missed:
+        # Owned but already gone (or being deleted): a concurrent delete got there first
+        results.update(await batch_miss_statuses(missed, seller_id, owned_status="not_found"))
+    
+    return {"results": [{"id": product_id, "status": results[product_id]} for product_id in ids]}
 
 # Basic route for testing
 @api_router.get("/")
 async def root():
     return {"message": "ThriftHub API is running!"}
 
+# Uploaded image serving
+# Stored images never change once written, so they are served with a
+# far-future immutable cache policy, strong ETags, 304 revalidation and
+# single byte-range support. FileResponse uses zero-copy "pathsend" when the
+# ASGI server offers it; setting UPLOADS_ACCEL_REDIRECT hands the transfer
+# to nginx (X-Accel-Redirect) instead.
+UPLOAD_CACHE_CONTROL = "public, max-age=31536000, immutable"
+UPLOADS_ACCEL_REDIRECT = os.environ.get("UPLOADS_ACCEL_REDIRECT")
+CONTENT_ADDRESSED_NAME = re.compile(r"[0-9a-f]{64}(-\w+)?\.\w+")
+upload_etag_cache = TTLCache(maxsize=10_000, ttl=3600)
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def upload_etag(path: Path, stat_result: os.stat_result) -> str:
+    """Strong ETag derived from the file content"""
+    if CONTENT_ADDRESSED_NAME.fullmatch(path.name):
+        # The name already is the content hash
+        return f'"{path.name}"'
+    # Files uploaded before content addressing are hashed once and remembered
+    cache_key = (str(path), stat_result.st_mtime_ns, stat_result.st_size)
+    etag = upload_etag_cache.get(cache_key)
+    if etag is None:
+        etag = f'"{await run_in_threadpool(hash_file, path)}"'
+        upload_etag_cache.set(cache_key, etag)
+    return etag
+
+class RangeNotSatisfiable(ValueError):
+    """A well-formed byte range that lies entirely outside the representation"""
+
+def parse_byte_range(header: str, size: int) -> Optional[tuple]:
+    """(start, end) for a single "bytes=" range, or None when the header should be ignored.
+    
+    Multiple ranges, other units and malformed ranges are ignored (the full
+    file is served); a valid range past the end raises RangeNotSatisfiable.
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            raise RangeNotSatisfiable(header)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the final N bytes
+        if int(last) == 0 or size == 0:
+            raise RangeNotSatisfiable(header)
+        start = max(size - int(last), 0)
+        end = size - 1
+    return start, end
+
+def if_range_matches(if_range: Optional[str], etag: str, last_modified: str) -> bool:
+    """Whether a Range request may be answered partially given its If-Range validator"""
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', "W/")):
+        # Strong comparison: a weak validator never matches
+        return not etag.startswith("W/") and if_range == etag
+    return if_range == last_modified
+
+def iter_file_range(path: Path, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+@app.api_route("/uploads/{key:path}", methods=["GET", "HEAD"])
+async def serve_upload(key: str, request: Request):
+    """Serve an uploaded image with immutable caching, ETags and range support"""
+    root = uploads_dir.resolve()
+    path = (uploads_dir / key).resolve()
+    if root not in path.parents or any(part.startswith(".") for part in Path(key).parts):
+        raise HTTPException(status_code=404, detail="Not found")
+    try:
+        stat_result = await run_in_threadpool(os.stat, path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="Not found")
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    etag = await upload_etag(path, stat_result)
+    headers = {
+        "Cache-Control": UPLOAD_CACHE_CONTROL,
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+    }
+    media_type = IMAGE_CONTENT_TYPES.get(path.suffix) or mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    
+    if is_not_modified(request, etag, datetime.utcfromtimestamp(stat_result.st_mtime)):
+        return Response(status_code=304, headers=headers)
+    
+    range_header = request.headers.get("range")
+    byte_range = None
+    if range_header and if_range_matches(request.headers.get("if-range"), etag, headers["Last-Modified"]):
+        try:
+            byte_range = parse_byte_range(range_header, stat_result.st_size)
+        except RangeNotSatisfiable:
+            return Response(
+                status_code=416,
+                headers={**headers, "Content-Range": f"bytes */{stat_result.st_size}"}
+            )
+    if byte_range is not None:
+        start, end = byte_range
+        headers.update({
+            "Content-Range": f"bytes {start}-{end}/{stat_result.st_size}",
+            "Content-Length": str(end - start + 1),
+        })
+        if request.method == "HEAD":
+            return Response(status_code=206, headers=headers, media_type=media_type)
+        return StreamingResponse(
+            iter_file_range(path, start, end), status_code=206, headers=headers, media_type=media_type
+        )
+    
+    if UPLOADS_ACCEL_REDIRECT:
+        headers["X-Accel-Redirect"] = f"{UPLOADS_ACCEL_REDIRECT.rstrip('/')}/{key}"
+        return Response(headers=headers, media_type=media_type)
+    
+    return FileResponse(path, headers=headers, media_type=media_type, stat_result=stat_result)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus scrape endpoint"""
+    return metrics.render()
+
 # Include the router in the main app
 app.include_router(api_router)
 
+# Added before CORS so CORSMiddleware wraps it and its 413s carry CORS headers
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=MAX_UPLOAD_REQUEST_BYTES)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
+# Added last so it wraps every other middleware and measures the whole request
+app.add_middleware(RequestProfilingMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -698,6 +2805,275 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def startup_db_indexes():
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def startup_view_counter():
+    view_counter.start()
+
+@app.on_event("startup")
+async def startup_message_broker():
+    await message_broker.start()
+
+@app.on_event("startup")
+async def startup_image_pool():
+    start_image_pool()
+
+@app.on_event("shutdown")
+async def shutdown_message_broker():
+    await message_broker.stop()
+
+@app.on_event("shutdown")
+async def shutdown_view_counter():
+    await view_counter.stop()
+
+@app.on_event("shutdown")
+async def shutdown_password_pool():
+    password_executor.shutdown(wait=False)
+
+@app.on_event("shutdown")
+async def shutdown_image_pool():
+    stop_image_pool()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+
+# Maintenance commands
+# Representative query for each route, used to check index usage with explain()
+QUERY_SHAPES = [
+    ("GET /api/auth/me", "users", {"id": "sample-user"}, None),
+    ("POST /api/auth/login", "users", {"email": "sample@example.com"}, None),
+    ("GET /api/products", "products", {"is_sold": False}, FEED_SORT),
+    ("GET /api/products?category=", "products", {"is_sold": False, "category": "electronics"}, FEED_SORT),
+    (
+        "GET /api/products?search=",
+        "products",
+        {"is_sold": False, "$text": {"$search": "vintage lamp"}},
+        [("score", {"$meta": "textScore"}), ("created_at", DESCENDING)],
+    ),
+    ("GET /api/products/suggest", "products", {"is_sold": False, "$and": [{"keywords": {"$regex": "^vin"}}]}, None),
+    ("GET /api/products/{id}", "products", {"id": "sample-product"}, None),
+    (
+        "GET /api/users/{id}/products",
+        "products",
+        {"seller_id": "sample-user", "is_sold": False},
+        FEED_SORT,
+    ),
+    (
+        "GET /api/favorites",
+        "favorites",
+        {"user_id": "sample-user"},
+        [("created_at", DESCENDING), ("id", DESCENDING)],
+    ),
+    ("POST /api/favorites/{id}", "favorites", {"user_id": "sample-user", "product_id": "sample-product"}, None),
+    (
+        "GET /api/messages",
+        "conversations",
+        {"participants": "sample-user"},
+        [("updated_at", DESCENDING), ("key", DESCENDING)],
+    ),
+    (
+        "GET /api/messages/{conversation_id}",
+        "messages",
+        {
+            "product_id": "sample-product",
+            "$or": [
+                {"sender_id": "sample-user", "recipient_id": "other-user"},
+                {"sender_id": "other-user", "recipient_id": "sample-user"},
+            ],
+        },
+        [("timestamp", ASCENDING)],
+    ),
+    ("DELETE /api/products/{id}", "messages", {"product_id": {"$in": ["sample-product"]}}, None),
+    ("POST /api/products/batch/delete", "products", {"batch_op": "sample-token"}, None),
+]
+
+def summarize_plan(plan: dict) -> str:
+    """Flatten a winning plan into a readable stage chain, e.g. LIMIT <- FETCH <- IXSCAN(feed)"""
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage = f"{stage}({plan['indexName']})"
+        stages.append(stage)
+        if "inputStages" in plan:
+            stages.append("[" + " | ".join(summarize_plan(p) for p in plan["inputStages"]) + "]")
+            break
+        plan = plan.get("inputStage")
+    return " <- ".join(stages)
+
+async def explain_query_shapes():
+    """Print the explain() plan for every route's query shape"""
+    for route, collection_name, query, sort in QUERY_SHAPES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+        winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+        stats = explanation.get("executionStats", {})
+        print(json.dumps({
+            "route": route,
+            "collection": collection_name,
+            "plan": summarize_plan(winning_plan.get("queryPlan", winning_plan)),
+            "docs_examined": stats.get("totalDocsExamined"),
+            "keys_examined": stats.get("totalKeysExamined"),
+            "returned": stats.get("nReturned"),
+        }))
+
+async def backfill_keywords():
+    """Populate search tokens on products created before keyword indexing"""
+    cursor = db.products.find(
+        {"keywords": {"$exists": False}},
+        {"_id": 0, "id": 1, "title": 1, "description": 1, "tags": 1}
+    )
+    batch = []
+    updated = 0
+    async for product in cursor:
+        keywords = build_keywords(product.get("title"), product.get("description"), product.get("tags", []))
+        batch.append(UpdateOne({"id": product["id"]}, {"$set": {"keywords": keywords}}))
+        if len(batch) >= 1000:
+            await db.products.bulk_write(batch, ordered=False)
+            updated += len(batch)
+            batch = []
+    if batch:
+        await db.products.bulk_write(batch, ordered=False)
+        updated += len(batch)
+    print(f"Backfilled keywords on {updated} products")
+
+async def recount_favorites():
+    """Recompute the denormalized favorite_count on every product from `favorites`"""
+    counts = {}
+    async for row in db.favorites.aggregate([{"$group": {"_id": "$product_id", "count": {"$sum": 1}}}]):
+        counts[row["_id"]] = row["count"]
+    batch = []
+    updated = 0
+    async for product in db.products.find({}, {"_id": 0, "id": 1, "favorite_count": 1}):
+        count = counts.get(product["id"], 0)
+        if product.get("favorite_count") != count:
+            batch.append(UpdateOne({"id": product["id"]}, {"$set": {"favorite_count": count}}))
+        if len(batch) >= 1000:
+            await db.products.bulk_write(batch, ordered=False)
+            updated += len(batch)
+            batch = []
+    if batch:
+        await db.products.bulk_write(batch, ordered=False)
+        updated += len(batch)
+    print(f"Corrected favorite_count on {updated} products")
+
+async def rebuild_conversations():
+    """Regenerate the conversations collection from messages"""
+    started_at = datetime.utcnow()
+    pipeline = [
+        {"$sort": {"timestamp": -1}},
+        {"$project": {"_id": 0}},
+        {"$group": {
+            "_id": {
+                "first": {"$min": ["$sender_id", "$recipient_id"]},
+                "second": {"$max": ["$sender_id", "$recipient_id"]},
+                "product_id": "$product_id"
+            },
+            "last_message": {"$first": "$$ROOT"},
+            "unread_first": {"$sum": {"$cond": [
+                {"$and": [{"$eq": ["$recipient_id", {"$min": ["$sender_id", "$recipient_id"]}]},
+                          {"$eq": ["$is_read", False]}]}, 1, 0
+            ]}},
+            "unread_second": {"$sum": {"$cond": [
+                {"$and": [{"$eq": ["$recipient_id", {"$max": ["$sender_id", "$recipient_id"]}]},
+                          {"$eq": ["$is_read", False]}]}, 1, 0
+            ]}}
+        }},
+    ]
+    batch = []
+    rebuilt = 0
+    async for group in db.messages.aggregate(pipeline, allowDiskUse=True):
+        first, second, product_id = group["_id"]["first"], group["_id"]["second"], group["_id"]["product_id"]
+        unread = {first: group["unread_first"]}
+        if second != first:
+            unread[second] = group["unread_second"]
+        key = conversation_key(first, second, product_id)
+        batch.append(UpdateOne(
+            {"key": key},
+            {"$set": {
+                "key": key,
+                "participants": [first, second],
+                "product_id": product_id,
+                "last_message": group["last_message"],
+                "unread": unread,
+                "updated_at": group["last_message"]["timestamp"],
+                "rebuilt_at": started_at
+            }},
+            upsert=True
+        ))
+        if len(batch) >= 1000:
+            await db.conversations.bulk_write(batch, ordered=False)
+            rebuilt += len(batch)
+            batch = []
+    if batch:
+        await db.conversations.bulk_write(batch, ordered=False)
+        rebuilt += len(batch)
+    
+    # Anything not touched by this run no longer has messages behind it, unless
+    # a message sent since the run started created or updated it
+    stale = await db.conversations.delete_many({
+        "$or": [{"rebuilt_at": {"$lt": started_at}}, {"rebuilt_at": {"$exists": False}}],
+        "updated_at": {"$lt": started_at}
+    })
+    print(f"Rebuilt {rebuilt} conversations, removed {stale.deleted_count} stale")
+
+async def collect_image(image: dict, cutoff: datetime) -> bool:
+    """Delete one unreferenced image and its variants under a GC lease; True if it was removed"""
+    now = datetime.utcnow()
+    lease_until = now + timedelta(seconds=IMAGE_GC_LEASE_SECONDS)
+    claimed = await db.images.find_one_and_update(
+        {
+            "key": image["key"], "refs": {"$lte": 0}, "updated_at": {"$lt": cutoff},
+            "$or": [{"deleting_until": None}, {"deleting_until": {"$lt": now}}],
+        },
+        {"$set": {"deleting_until": lease_until}},
+        projection={"_id": 0}
+    )
+    if claimed is None:
+        return False
+    
+    keys = [claimed["key"]]
+    for variant in (claimed.get("variants") or {}).values():
+        keys.extend([variant["webp"], variant["jpeg"]])
+    for key in keys:
+        # Past this point an upload may take the key over, so leave the rest for the next run
+        if datetime.utcnow() > lease_until - timedelta(seconds=IMAGE_GC_LEASE_MARGIN_SECONDS):
+            logging.error(f"GC lease on image {claimed['key']} ran short; retrying on the next run")
+            return False
+        await run_in_threadpool(image_store.delete, key)
+    
+    # The row goes only once the blobs are gone, which releases waiting uploads
+    await db.images.delete_one({"key": claimed["key"], "deleting_until": lease_until})
+    return True
+
+async def gc_images():
+    """Delete stored images (and their variants) that no product references"""
+    cutoff = datetime.utcnow() - timedelta(seconds=IMAGE_GC_GRACE_SECONDS)
+    removed = 0
+    freed = 0
+    async for image in db.images.find({"refs": {"$lte": 0}, "updated_at": {"$lt": cutoff}}, {"_id": 0}):
+        if await collect_image(image, cutoff):
+            removed += 1
+            freed += image.get("size", 0)
+    print(f"Removed {removed} unreferenced images ({freed} bytes of originals)")
+
+COMMANDS = {
+    "ensure-indexes": ensure_indexes,
+    "explain": explain_query_shapes,
+    "backfill-keywords": backfill_keywords,
+    "rebuild-conversations": rebuild_conversations,
+    "recount-favorites": recount_favorites,
+    "gc-images": gc_images,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ThriftHub backend maintenance commands")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args()
+    asyncio.run(COMMANDS[args.command]())
@@ -1,7 +1,7 @@
 import React from 'react';
 import { Grid, Smartphone, Gamepad2, ShoppingBag, Shirt, Car, Home as HomeIcon, Book, Music, Camera, Filter, MapPin } from 'lucide-react';
 
-const Sidebar = ({ activeCategory, onCategoryChange }) => {
+const Sidebar = ({ activeCategory, onCategoryChange, facets }) => {
   const categories = [
     { id: 'all', name: 'Browse all', icon: Grid },
     { id: 'electronics', name: 'Electronics', icon: Smartphone },
@@ -30,6 +30,11 @@ const Sidebar = ({ activeCategory, onCategoryChange }) => {
     'Above ₹10,000'
   ];
 
+  // Counts from /api/products/facets; category counts ignore the selected category
+  const categoryCounts = Object.fromEntries((facets?.category || []).map(({ value, count }) => [value, count]));
+  categoryCounts.all = Object.values(categoryCounts).reduce((sum, count) => sum + count, 0);
+  const priceCounts = (facets?.price || []).map(({ count }) => count);
+
   const conditions = [
     'Like New',
     'Excellent',
@@ -62,6 +67,9 @@ const Sidebar = ({ activeCategory, onCategoryChange }) => {
                 >
                   <IconComponent className="w-4 h-4 mr-3" />
                   <span className="text-sm">{category.name}</span>
+                  {facets && (
+                    <span className="ml-auto text-xs text-gray-400">{categoryCounts[category.id] || 0}</span>
+                  )}
                 </button>
               );
             })}
@@ -96,6 +104,9 @@ const Sidebar = ({ activeCategory, onCategoryChange }) => {
                   className="w-4 h-4 text-gray-900 border-gray-300 focus:ring-gray-500 focus:ring-1"
                 />
                 <span className="ml-3 text-sm text-gray-600 group-hover:text-gray-900">{range}</span>
+                {priceCounts[index] !== undefined && (
+                  <span className="ml-auto text-xs text-gray-400">{priceCounts[index]}</span>
+                )}
               </label>
             ))}
           </div>
@@ -18,7 +18,7 @@ const ProductCard = ({ product, onFavorite, onProductClick }) => {
         {/* Image Container */}
         <div className="relative aspect-square overflow-hidden">
           <img
-            src={product.images[0]}
+            src={product.thumbnail || product.images[0]}
             alt={product.title}
             className="w-full h-full object-cover group-hover:scale-105 transition-transform duration-500"
           />
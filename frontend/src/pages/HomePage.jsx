@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef, useCallback } from 'react';
 import Header from '../components/ui/layout/Header';
 import Sidebar from '../components/ui/layout/Sidebar';
 import ProductCard from '../components/ui/product/ProductCard';
@@ -11,11 +11,22 @@ const HomePage = () => {
   const [activeCategory, setActiveCategory] = useState('all');
   const [products, setProducts] = useState([]);
   const [favorites, setFavorites] = useState(new Set());
+  const [facets, setFacets] = useState(null);
   const [isLoading, setIsLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
+  const loadMoreRef = useRef(null);
   const { isAuthenticated } = useAuth();
   const navigate = useNavigate();
   const { toast } = useToast();
 
+  // Signed-in feed pages carry is_favorited, so hearts need no separate favorites request
+  const mergeFavorited = useCallback((pageProducts = []) => {
+    const favoritedIds = pageProducts.filter(p => p.is_favorited).map(p => p.id);
+    if (favoritedIds.length === 0) return;
+    setFavorites(prev => new Set([...prev, ...favoritedIds]));
+  }, []);
+
   // Fetch products when category changes
   useEffect(() => {
     const fetchProducts = async () => {
@@ -28,6 +39,8 @@ const HomePage = () => {
         
         const data = await productsAPI.getProducts(params);
         setProducts(data.products || []);
+        setNextCursor(data.next_cursor || null);
+        mergeFavorited(data.products);
       } catch (error) {
         console.error('Error fetching products:', error);
         toast({
@@ -41,24 +54,61 @@ const HomePage = () => {
     };
 
     fetchProducts();
-  }, [activeCategory, toast]);
+  }, [activeCategory, isAuthenticated, mergeFavorited, toast]);
 
-  // Fetch user favorites if authenticated
+  // Sidebar counts come from one facets request per filter change
   useEffect(() => {
-    const fetchFavorites = async () => {
-      if (isAuthenticated) {
-        try {
-          const favoriteProducts = await favoritesAPI.getFavorites();
-          const favoriteIds = new Set(favoriteProducts.map(p => p.id));
-          setFavorites(favoriteIds);
-        } catch (error) {
-          console.error('Error fetching favorites:', error);
+    const fetchFacets = async () => {
+      try {
+        const params = {};
+        if (activeCategory !== 'all') {
+          params.category = activeCategory;
         }
+        setFacets(await productsAPI.getFacets(params));
+      } catch (error) {
+        console.error('Error fetching facets:', error);
       }
     };
 
-    fetchFavorites();
-  }, [isAuthenticated]);
+    fetchFacets();
+  }, [activeCategory]);
+
+  // Fetch the next page using the keyset cursor from the previous response
+  const loadMore = useCallback(async () => {
+    if (!nextCursor || isLoadingMore) return;
+
+    try {
+      setIsLoadingMore(true);
+      const params = { cursor: nextCursor, include_total: false };
+      if (activeCategory !== 'all') {
+        params.category = activeCategory;
+      }
+
+      const data = await productsAPI.getProducts(params);
+      setProducts(prev => [...prev, ...(data.products || [])]);
+      setNextCursor(data.next_cursor || null);
+      mergeFavorited(data.products);
+    } catch (error) {
+      console.error('Error loading more products:', error);
+    } finally {
+      setIsLoadingMore(false);
+    }
+  }, [nextCursor, isLoadingMore, activeCategory, mergeFavorited]);
+
+  // Infinite scroll: load the next page when the sentinel comes into view
+  useEffect(() => {
+    const sentinel = loadMoreRef.current;
+    if (!sentinel || !nextCursor) return;
+
+    const observer = new IntersectionObserver((entries) => {
+      if (entries[0].isIntersecting) {
+        loadMore();
+      }
+    }, { rootMargin: '400px' });
+
+    observer.observe(sentinel);
+    return () => observer.disconnect();
+  }, [loadMore, nextCursor]);
 
   const handleFavorite = async (productId) => {
     if (!isAuthenticated) {
@@ -154,6 +204,7 @@ const HomePage = () => {
         <Sidebar 
           activeCategory={activeCategory} 
           onCategoryChange={setActiveCategory}
+          facets={facets}
         />
         
         {/* Main Content */}
@@ -199,6 +250,13 @@ const HomePage = () => {
               </div>
             )}
 
+            {/* Infinite Scroll Sentinel */}
+            {!isLoading && nextCursor && (
+              <div ref={loadMoreRef} className="py-8 text-center text-sm text-gray-400">
+                {isLoadingMore ? 'Loading more...' : ''}
+              </div>
+            )}
+
             {/* Empty State */}
             {!isLoading && productsWithFavorites.length === 0 && (
               <div className="text-center py-16">
@@ -83,9 +83,13 @@ export const productsAPI = {
     
     Object.keys(productData).forEach(key => {
       if (key === 'images') {
-        // Handle images array
-        productData.images.forEach((image, index) => {
-          formData.append('images', image);
+        // Files are streamed as multipart parts; base64 strings use the legacy field
+        productData.images.forEach((image) => {
+          if (image instanceof Blob) {
+            formData.append('image_files', image);
+          } else {
+            formData.append('images', image);
+          }
         });
       } else if (key === 'tags') {
         // Convert tags array to comma-separated string
@@ -103,8 +107,10 @@ export const productsAPI = {
     return response.data;
   },
 
-  updateProduct: async (productId, updateData) => {
-    const response = await api.put(`/products/${productId}`, updateData);
+  // Pass the ETag from a previous read to get a 412 instead of overwriting someone else's edit
+  updateProduct: async (productId, updateData, etag) => {
+    const headers = etag ? { 'If-Match': etag } : {};
+    const response = await api.put(`/products/${productId}`, updateData, { headers });
     return response.data;
   },
 
@@ -113,6 +119,17 @@ export const productsAPI = {
     return response.data;
   },
 
+  // Shared patch (e.g. { is_sold: true } or { price: 500 }) for several own listings
+  batchUpdateProducts: async (productIds, patch) => {
+    const response = await api.patch('/products/batch', { ids: productIds, patch });
+    return response.data;
+  },
+
+  batchDeleteProducts: async (productIds) => {
+    const response = await api.post('/products/batch/delete', { ids: productIds });
+    return response.data;
+  },
+
   searchProducts: async (searchQuery, filters = {}) => {
     const params = {
       search: searchQuery,
@@ -120,13 +137,24 @@ export const productsAPI = {
     };
     const response = await api.get('/products', { params });
     return response.data;
+  },
+
+  suggestProducts: async (query, limit = 8) => {
+    const response = await api.get('/products/suggest', { params: { q: query, limit } });
+    return response.data;
+  },
+
+  // Sidebar counts per category, condition, location and price range for the same filters as getProducts
+  getFacets: async (params = {}) => {
+    const response = await api.get('/products/facets', { params });
+    return response.data;
   }
 };
 
 // Favorites API
 export const favoritesAPI = {
-  getFavorites: async () => {
-    const response = await api.get('/favorites');
+  getFavorites: async (params = {}) => {
+    const response = await api.get('/favorites', { params });
     return response.data;
   },
 
@@ -143,8 +171,8 @@ export const favoritesAPI = {
 
 // Messages API
 export const messagesAPI = {
-  getConversations: async () => {
-    const response = await api.get('/messages');
+  getConversations: async (params = {}) => {
+    const response = await api.get('/messages', { params });
     return response.data;
   },
 
@@ -156,6 +184,18 @@ export const messagesAPI = {
   sendMessage: async (messageData) => {
     const response = await api.post('/messages', messageData);
     return response.data;
+  },
+
+  // Push channel for new messages; returns a function that closes the stream
+  subscribe: (onMessage) => {
+    const token = localStorage.getItem(TOKEN_KEY);
+    if (!token) return () => {};
+
+    const source = new EventSource(`${API_URL}/messages/stream?token=${encodeURIComponent(token)}`);
+    source.addEventListener('message', (event) => {
+      onMessage(JSON.parse(event.data));
+    });
+    return () => source.close();
   }
 };
 
@@ -166,8 +206,9 @@ export const usersAPI = {
     return response.data;
   },
 
-  updateProfile: async (userId, updateData) => {
-    const response = await api.put(`/users/${userId}`, updateData);
+  updateProfile: async (userId, updateData, etag) => {
+    const headers = etag ? { 'If-Match': etag } : {};
+    const response = await api.put(`/users/${userId}`, updateData, { headers });
     return response.data;
   },
 
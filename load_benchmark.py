@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+ThriftHub Load Benchmark
+Seeds a database with a configurable volume of users, products, favorites and
+messages, drives a concurrent mix of traffic across the API, and reports
+throughput plus p50/p95/p99 latency per endpoint as JSON that can be compared
+between commits.
+
+By default the app runs in-process (httpx ASGI transport) against a local
+MongoDB database named thrifthub_bench. --in-memory swaps in mongomock-motor
+instead (text search, aggregation and change streams are limited there), and
+--base-url drives an already running server (pointed at the same database)
+instead of the in-process app.
+
+DB round trips per request are read from the Server-Timing header (MongoDB
+only; mongomock-motor bypasses the command listener), so --compare also
+catches query-count regressions. --query-debug raise makes any request over
+its QUERY_BUDGETS entry, or repeating a query shape, count as an error.
+
+Usage:
+    python load_benchmark.py --duration 30 --concurrency 32 --output bench.json
+    python load_benchmark.py --compare bench.json --fail-on-regression 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+PASSWORD = "BenchPassword123!"
+CATEGORIES = ["electronics", "fashion", "vehicles", "home", "books", "sports", "collectibles"]
+CONDITIONS = ["new", "like-new", "good", "fair"]
+LOCATIONS = ["Mumbai", "Delhi", "Bengaluru", "Pune", "Chennai", "Kolkata", "Hyderabad"]
+WORDS = [
+    "vintage", "camera", "leather", "jacket", "bicycle", "guitar", "lamp", "sofa", "novel",
+    "watch", "sneakers", "laptop", "phone", "table", "mirror", "poster", "vinyl", "racket",
+]
+
+SERVER_TIMING_DB = re.compile(r'db;dur=[\d.]+;desc="(\d+) round trips"')
+
+# Relative weight of each scenario in the traffic mix
+DEFAULT_MIX = {
+    "feed": 30,
+    "feed_next_page": 8,
+    "search": 10,
+    "suggest": 6,
+    "facets": 5,
+    "detail": 20,
+    "profile": 4,
+    "user_products": 4,
+    "login": 2,
+    "me": 3,
+    "favorites": 4,
+    "inbox": 5,
+    "thread": 3,
+    "send": 1,
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Seeder:
+    """Writes synthetic data straight into the database the server uses"""
+
+    def __init__(self, server, args):
+        self.server = server
+        self.db = server.db
+        self.args = args
+
+    async def seed(self):
+        rng = random.Random(self.args.seed)
+        for name in ("users", "products", "favorites", "messages", "conversations", "images", "response_cache"):
+            await self.db[name].delete_many({})
+        await self.server.ensure_indexes()
+
+        password_hash = self.server.get_password_hash(PASSWORD)
+        now = datetime.utcnow()
+
+        users = []
+        for i in range(self.args.users):
+            user = self.server.User(
+                name=f"Bench User {i}",
+                email=f"bench{i}@example.com",
+                phone="+910000000000",
+                location=rng.choice(LOCATIONS),
+            ).dict()
+            user["password_hash"] = password_hash
+            users.append(user)
+        await self.insert("users", users)
+
+        products = []
+        for i in range(self.args.products):
+            words = rng.sample(WORDS, 3)
+            title = " ".join(words).title()
+            description = f"Pre-loved {' '.join(words)} in great shape. " * 4
+            tags = rng.sample(WORDS, 2)
+            created_at = now - timedelta(minutes=i)
+            product = self.server.Product(
+                title=title,
+                description=description,
+                price=round(rng.uniform(5, 2000), 2),
+                category=rng.choice(CATEGORIES),
+                condition=rng.choice(CONDITIONS),
+                location=rng.choice(LOCATIONS),
+                tags=tags,
+                seller_id=rng.choice(users)["id"],
+                created_at=created_at,
+                updated_at=created_at,
+            ).dict()
+            product["keywords"] = self.server.build_keywords(title, description, tags)
+            products.append(product)
+        await self.insert("products", products)
+
+        favorites = {}
+        while len(favorites) < min(self.args.favorites, len(users) * len(products)):
+            user_id, product_id = rng.choice(users)["id"], rng.choice(products)["id"]
+            favorites[(user_id, product_id)] = self.server.Favorite(user_id=user_id, product_id=product_id).dict()
+        await self.insert("favorites", list(favorites.values()))
+        await self.server.recount_favorites()
+
+        messages = []
+        for i in range(self.args.messages):
+            sender, recipient = rng.sample(users, 2)
+            messages.append(self.server.Message(
+                sender_id=sender["id"],
+                recipient_id=recipient["id"],
+                product_id=rng.choice(products)["id"],
+                content=f"Is this still available? ({i})",
+                timestamp=now - timedelta(seconds=i),
+                is_read=rng.random() < 0.7,
+            ).dict())
+        await self.insert("messages", messages)
+        if messages:
+            await self.server.rebuild_conversations()
+
+        return users, products, messages
+
+    async def insert(self, collection, documents, batch_size=5000):
+        for start in range(0, len(documents), batch_size):
+            await self.db[collection].insert_many(documents[start:start + batch_size], ordered=False)
+
+
+class Benchmark:
+    def __init__(self, client, args, users, products, messages):
+        self.client = client
+        self.args = args
+        self.users = users
+        self.products = products
+        self.messages = messages
+        self.tokens = {}
+        self.cursors = []
+        self.latencies = defaultdict(list)
+        self.round_trips = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.rng = random.Random(args.seed)
+
+    async def login(self, user):
+        response = await self.client.post("/api/auth/login", json={"email": user["email"], "password": PASSWORD})
+        response.raise_for_status()
+        self.tokens[user["id"]] = response.json()["access_token"]
+
+    def auth(self, user):
+        return {"Authorization": f"Bearer {self.tokens[user['id']]}"}
+
+    async def timed(self, name, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            response, status = None, "error"
+        self.latencies[name].append(time.perf_counter() - started)
+        self.statuses[name][str(status)] += 1
+        # Round trips per request come from the server's Server-Timing header
+        match = response is not None and SERVER_TIMING_DB.search(response.headers.get("server-timing", ""))
+        if match:
+            self.round_trips[name].append(int(match.group(1)))
+        return response
+
+    async def run_scenario(self, name):
+        rng = self.rng
+        user = rng.choice(self.active_users)
+        if name == "feed":
+            params = {"limit": 20}
+            if rng.random() < 0.5:
+                params["category"] = rng.choice(CATEGORIES)
+            # Signed-in feeds also pay for the is_favorited lookup
+            headers = self.auth(user) if rng.random() < 0.5 else None
+            response = await self.timed(name, "GET", "/api/products", params=params, headers=headers)
+            if response is not None and response.status_code == 200:
+                next_cursor = response.json().get("next_cursor")
+                if next_cursor:
+                    self.cursors.append(next_cursor)
+                    del self.cursors[:-100]
+        elif name == "feed_next_page":
+            if not self.cursors:
+                return await self.run_scenario("feed")
+            params = {"limit": 20, "cursor": rng.choice(self.cursors), "include_total": "false"}
+            await self.timed(name, "GET", "/api/products", params=params)
+        elif name == "search":
+            await self.timed(name, "GET", "/api/products", params={"search": rng.choice(WORDS), "limit": 20})
+        elif name == "suggest":
+            await self.timed(name, "GET", "/api/products/suggest", params={"q": rng.choice(WORDS)[:3]})
+        elif name == "facets":
+            params = {"category": rng.choice(CATEGORIES)} if rng.random() < 0.5 else {}
+            await self.timed(name, "GET", "/api/products/facets", params=params)
+        elif name == "detail":
+            await self.timed(name, "GET", f"/api/products/{rng.choice(self.products)['id']}")
+        elif name == "profile":
+            await self.timed(name, "GET", f"/api/users/{rng.choice(self.users)['id']}")
+        elif name == "user_products":
+            await self.timed(name, "GET", f"/api/users/{rng.choice(self.users)['id']}/products")
+        elif name == "login":
+            await self.timed(
+                name, "POST", "/api/auth/login", json={"email": user["email"], "password": PASSWORD}
+            )
+        elif name == "me":
+            await self.timed(name, "GET", "/api/auth/me", headers=self.auth(user))
+        elif name == "favorites":
+            await self.timed(name, "GET", "/api/favorites", headers=self.auth(user))
+        elif name == "inbox":
+            await self.timed(name, "GET", "/api/messages", headers=self.auth(user))
+        elif name == "thread":
+            if not self.inbox_messages:
+                return
+            message = rng.choice(self.inbox_messages)
+            headers = {"Authorization": f"Bearer {self.tokens[message['recipient_id']]}"}
+            url = f"/api/messages/{message['sender_id']}_{message['product_id']}"
+            await self.timed(name, "GET", url, headers=headers)
+        elif name == "send":
+            recipient = rng.choice(self.users)
+            product = rng.choice(self.products)
+            payload = {"recipient_id": recipient["id"], "product_id": product["id"], "content": "Still available?"}
+            await self.timed(name, "POST", "/api/messages", json=payload, headers=self.auth(user))
+
+    async def worker(self, deadline, scenarios, weights):
+        while time.perf_counter() < deadline:
+            await self.run_scenario(self.rng.choices(scenarios, weights)[0])
+
+    async def run(self):
+        self.active_users = self.users[: self.args.active_users]
+        await asyncio.gather(*(self.login(user) for user in self.active_users))
+        self.inbox_messages = [m for m in self.messages if m["recipient_id"] in self.tokens]
+
+        mix = dict(DEFAULT_MIX)
+        if self.args.mix:
+            mix = {k: float(v) for k, v in (item.split("=") for item in self.args.mix.split(","))}
+        scenarios, weights = zip(*[(k, v) for k, v in mix.items() if v > 0])
+
+        if self.args.warmup > 0:
+            warmup_deadline = time.perf_counter() + self.args.warmup
+            await asyncio.gather(*(self.worker(warmup_deadline, scenarios, weights) for _ in range(self.args.concurrency)))
+            self.latencies.clear()
+            self.round_trips.clear()
+            self.statuses.clear()
+
+        started = time.perf_counter()
+        deadline = started + self.args.duration
+        await asyncio.gather(*(self.worker(deadline, scenarios, weights) for _ in range(self.args.concurrency)))
+        elapsed = time.perf_counter() - started
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        endpoints = {}
+        total = 0
+        for name, samples in sorted(self.latencies.items()):
+            ordered = sorted(samples)
+            total += len(ordered)
+            errors = sum(count for status, count in self.statuses[name].items() if not status.startswith(("2", "3")))
+            endpoints[name] = {
+                "requests": len(ordered),
+                "errors": errors,
+                "rps": round(len(ordered) / elapsed, 1),
+                "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+                "max_ms": round(ordered[-1] * 1000, 2),
+                "statuses": dict(self.statuses[name]),
+            }
+            if self.round_trips[name]:
+                trips = self.round_trips[name]
+                endpoints[name]["db_round_trips_avg"] = round(sum(trips) / len(trips), 2)
+                endpoints[name]["db_round_trips_max"] = max(trips)
+        return {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "config": {
+                key: getattr(self.args, key)
+                for key in ("users", "products", "favorites", "messages", "concurrency", "duration", "active_users", "seed")
+            },
+            "duration_s": round(elapsed, 2),
+            "total_requests": total,
+            "total_rps": round(total / elapsed, 1),
+            "endpoints": endpoints,
+        }
+
+
+def compare(current, baseline, threshold):
+    """Print p95/p99 and round-trip deltas against a previous run.
+
+    Returns the endpoints whose p95 grew by more than threshold percent and
+    the endpoints whose worst-case DB round trips per request went up.
+    """
+    slower, chattier = [], []
+    print(
+        f"{'endpoint':<16}{'p95 base':>10}{'p95 now':>10}{'delta':>9}{'p99 base':>10}{'p99 now':>10}{'trips':>10}",
+        file=sys.stderr,
+    )
+    for name, stats in current["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(name)
+        if not base:
+            continue
+        delta = (stats["p95_ms"] - base["p95_ms"]) / base["p95_ms"] * 100 if base["p95_ms"] else 0.0
+        trips = f"{base.get('db_round_trips_max', '-')}->{stats.get('db_round_trips_max', '-')}"
+        print(
+            f"{name:<16}{base['p95_ms']:>10}{stats['p95_ms']:>10}{delta:>8.1f}%"
+            f"{base['p99_ms']:>10}{stats['p99_ms']:>10}{trips:>10}",
+            file=sys.stderr,
+        )
+        if threshold is not None and delta > threshold:
+            slower.append(name)
+        if "db_round_trips_max" in base and stats.get("db_round_trips_max", 0) > base["db_round_trips_max"]:
+            chattier.append(name)
+    return slower, chattier
+
+
+async def main(args):
+    # The server module is always imported: it seeds the database and, unless
+    # --base-url points at a running server sharing that database, serves traffic.
+    os.environ["DB_NAME"] = args.db_name
+    if args.query_debug:
+        os.environ["QUERY_DEBUG"] = args.query_debug
+    if args.mongo_url:
+        os.environ["MONGO_URL"] = args.mongo_url
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    if args.in_memory:
+        if args.base_url:
+            raise SystemExit("--in-memory cannot be combined with --base-url")
+        from mongomock_motor import AsyncMongoMockClient
+
+        server.client = AsyncMongoMockClient()
+        server.db = server.client[args.db_name]
+
+    users, products, messages = await Seeder(server, args).seed()
+
+    if args.base_url:
+        client = httpx.AsyncClient(base_url=args.base_url, timeout=30)
+    else:
+        # ASGITransport does not run lifespan events, so start the background workers here
+        # App exceptions (including QueryBudgetExceeded) are counted as 500s rather than aborting the run
+        transport = httpx.ASGITransport(app=server.app, raise_app_exceptions=False)
+        client = httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=30)
+        server.view_counter.start()
+        await server.message_broker.start()
+        server.start_image_pool()
+    try:
+        async with client:
+            result = await Benchmark(client, args, users, products, messages).run()
+    finally:
+        if not args.base_url:
+            await server.view_counter.stop()
+            await server.message_broker.stop()
+            server.stop_image_pool()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    print(output)
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        slower, chattier = compare(result, baseline, args.fail_on_regression)
+        failed = False
+        if slower:
+            print(f"p95 regressed beyond {args.fail_on_regression}%: {', '.join(slower)}", file=sys.stderr)
+            failed = True
+        if chattier:
+            print(f"More DB round trips per request: {', '.join(chattier)}", file=sys.stderr)
+            failed = failed or args.fail_on_query_regression
+        if failed:
+            return 1
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", help="drive a running server instead of the in-process app")
+    parser.add_argument("--mongo-url", help="MongoDB URL (defaults to MONGO_URL from backend/.env)")
+    parser.add_argument("--db-name", default="thrifthub_bench")
+    parser.add_argument("--in-memory", action="store_true", help="use mongomock-motor instead of MongoDB")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--products", type=int, default=20_000)
+    parser.add_argument("--favorites", type=int, default=10_000)
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--active-users", type=int, default=100, help="users logged in to drive traffic")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="unmeasured seconds before the run")
+    parser.add_argument("--mix", help="scenario weights, e.g. feed=10,detail=5,send=1")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    parser.add_argument("--fail-on-regression", type=float, help="exit 1 if any p95 grows by more than this %%")
+    parser.add_argument(
+        "--fail-on-query-regression", action="store_true", help="exit 1 if any endpoint makes more DB round trips"
+    )
+    parser.add_argument(
+        "--query-debug", choices=["warn", "raise"], help="run the in-process server with QUERY_DEBUG budgets enforced"
+    )
+    args = parser.parse_args()
+    args.active_users = min(args.active_users, args.users)
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
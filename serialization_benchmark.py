@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+ThriftHub Serialization Benchmark
+Measures the cost of encoding one product feed page with FastAPI's default
+path (jsonable_encoder + json.dumps) versus the orjson response class, for
+full product documents and for the card projection used by the feed routes.
+
+Usage: python serialization_benchmark.py [--items 100] [--iterations 500]
+"""
+
+import argparse
+import json
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+from server import PRODUCT_CARD_PROJECTION, FastJSONResponse  # noqa: E402
+
+
+def make_product(index):
+    """A product document shaped like the ones stored by create_product"""
+    now = datetime.utcnow() - timedelta(minutes=index)
+    image_hash = uuid.uuid4().hex * 2
+    variants = {
+        size: {
+            "webp": f"/uploads/variants/{image_hash}-{size}.webp",
+            "jpeg": f"/uploads/variants/{image_hash}-{size}.jpg",
+            "width": width,
+            "height": width,
+        }
+        for size, width in (("grid", 400), ("detail", 1000), ("full", 1600))
+    }
+    description = "Gently used, works perfectly, comes with original box and charger. " * 8
+    return {
+        "id": str(uuid.uuid4()),
+        "title": f"Vintage film camera #{index}",
+        "description": description,
+        "price": 120.0 + index,
+        "images": [f"/uploads/{uuid.uuid4().hex * 2}.jpg" for _ in range(5)],
+        "image_keys": [f"{uuid.uuid4().hex * 2}.jpg" for _ in range(5)],
+        "image_variants": [variants] * 5,
+        "thumbnail": variants["grid"]["webp"],
+        "category": "electronics",
+        "condition": "good",
+        "location": "Mumbai, Maharashtra",
+        "tags": ["camera", "film", "vintage", "analog", "35mm"],
+        "keywords": sorted(set(description.lower().split())) + ["camera", "film", "vintage"],
+        "seller_id": str(uuid.uuid4()),
+        "created_at": now,
+        "updated_at": now,
+        "views": 42 + index,
+        "is_sold": False,
+        "seller": {
+            "id": str(uuid.uuid4()),
+            "name": "Jane Seller",
+            "avatar": None,
+            "is_verified": True,
+            "rating": 4.8,
+            "total_sales": 17,
+        },
+    }
+
+
+def project(document, projection):
+    """Apply a find() projection the way MongoDB would for the fields we use"""
+    projected = {}
+    for field, rule in projection.items():
+        if field == "_id" or field not in document:
+            continue
+        if isinstance(rule, dict) and "$slice" in rule:
+            projected[field] = document[field][: rule["$slice"]]
+        elif rule:
+            projected[field] = document[field]
+    projected["seller"] = document["seller"]
+    return projected
+
+
+def default_encode(content):
+    """What FastAPI does for a returned dict: jsonable_encoder then JSONResponse.render"""
+    return json.dumps(
+        jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def orjson_encode(content):
+    return FastJSONResponse(content).body
+
+
+def measure(encode, content, iterations):
+    encode(content)  # warm up
+    started = time.perf_counter()
+    for _ in range(iterations):
+        body = encode(content)
+    elapsed = time.perf_counter() - started
+    return {"us_per_page": round(elapsed / iterations * 1_000_000, 1), "bytes": len(body)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=100, help="products per feed page")
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    products = [make_product(i) for i in range(args.items)]
+    full_page = {"products": products, "total": 10_000, "page": 1, "limit": args.items, "next_cursor": None}
+    card_page = dict(full_page, products=[project(p, PRODUCT_CARD_PROJECTION) for p in products])
+
+    results = {
+        "items": args.items,
+        "iterations": args.iterations,
+        "default_full": measure(default_encode, full_page, args.iterations),
+        "default_card": measure(default_encode, card_page, args.iterations),
+        "orjson_full": measure(orjson_encode, full_page, args.iterations),
+        "orjson_card": measure(orjson_encode, card_page, args.iterations),
+    }
+    results["speedup"] = round(
+        results["default_full"]["us_per_page"] / results["orjson_card"]["us_per_page"], 1
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+# server.py connects lazily, so importing it only needs these to be set
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "thrifthub_test")
+sys.path.insert(0, str(BACKEND_DIR))
+
+
+@pytest.fixture(scope="session")
+def server():
+    for module in ("fastapi", "motor", "PIL"):
+        pytest.importorskip(module)
+    import server as server_module
+
+    return server_module
+
+
+@pytest.fixture
+def mock_db(server, monkeypatch):
+    """An in-memory database swapped in for server.db"""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    db = mongomock_motor.AsyncMongoMockClient()["thrifthub_test"]
+    monkeypatch.setattr(server, "db", db)
+    return db
+
+
+@pytest.fixture
+def store(server, mock_db, monkeypatch, tmp_path):
+    """Local image store under tmp_path, with GC grace and polling shortened for tests"""
+    image_store = server.LocalImageStore(tmp_path / "uploads")
+    image_store.root.mkdir()
+    monkeypatch.setattr(server, "image_store", image_store)
+    monkeypatch.setattr(server, "upload_tmp_dir", tmp_path)
+    monkeypatch.setattr(server, "IMAGE_GC_GRACE_SECONDS", 0)
+    monkeypatch.setattr(server, "IMAGE_GC_POLL_SECONDS", 0.01)
+    asyncio.run(mock_db.images.create_index("key", unique=True))
+    return image_store
+
+
+@pytest.fixture
+def auth_headers(server, mock_db):
+    """Authorization header for a freshly inserted user"""
+    user = server.User(name="Test Seller", email="seller@example.com", phone="555-0100").dict()
+    asyncio.run(mock_db.users.insert_one(dict(user)))
+    token = server.create_access_token({"sub": user["id"]})
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def client(server):
+    from starlette.testclient import TestClient
+
+    return TestClient(server.app)
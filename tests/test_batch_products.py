@@ -0,0 +1,69 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def seller(server, mock_db, auth_headers):
+    """The user behind auth_headers"""
+    return asyncio.run(mock_db.users.find_one({}, {"_id": 0}))
+
+
+def insert_product(server, db, seller_id, **fields):
+    product = server.Product(
+        title="Lamp", description="Brass lamp", price=25, category="home", condition="good",
+        location="Berlin", seller_id=seller_id, **fields
+    ).dict()
+    product["image_keys"] = [f"{product['id']}.png"]
+    asyncio.run(db.products.insert_one(dict(product)))
+    asyncio.run(db.images.insert_one({"key": product["image_keys"][0], "refs": 1}))
+    return product["id"]
+
+
+def statuses(response):
+    assert response.status_code == 200, response.text
+    return {row["id"]: row["status"] for row in response.json()["results"]}
+
+
+def test_batch_update_reports_per_item_status(server, mock_db, client, auth_headers, seller):
+    own = insert_product(server, mock_db, seller["id"])
+    foreign = insert_product(server, mock_db, "someone-else")
+    response = client.patch(
+        "/api/products/batch",
+        json={"ids": [own, foreign, "missing"], "patch": {"price": 10}},
+        headers=auth_headers,
+    )
+    assert statuses(response) == {own: "updated", foreign: "forbidden", "missing": "not_found"}
+    assert asyncio.run(mock_db.products.find_one({"id": own}))["price"] == 10
+    assert asyncio.run(mock_db.products.find_one({"id": foreign}))["price"] == 25
+
+
+def test_batch_text_update_rebuilds_keywords(server, mock_db, client, auth_headers, seller):
+    own = insert_product(server, mock_db, seller["id"])
+    response = client.patch(
+        "/api/products/batch", json={"ids": [own], "patch": {"title": "Floor lamp"}}, headers=auth_headers
+    )
+    assert statuses(response) == {own: "updated"}
+    product = asyncio.run(mock_db.products.find_one({"id": own}))
+    assert "floor" in product["keywords"] and product["version"] == 2
+
+
+def test_batch_delete_cascades_each_product_once(server, mock_db, client, auth_headers, seller):
+    own = insert_product(server, mock_db, seller["id"])
+    foreign = insert_product(server, mock_db, "someone-else")
+    first = client.post("/api/products/batch/delete", json={"ids": [own, foreign]}, headers=auth_headers)
+    assert statuses(first) == {own: "deleted", foreign: "forbidden"}
+    second = client.post("/api/products/batch/delete", json={"ids": [own]}, headers=auth_headers)
+    assert statuses(second) == {own: "not_found"}
+    assert asyncio.run(mock_db.images.find_one({"key": f"{own}.png"}))["refs"] == 0
+    assert asyncio.run(mock_db.products.find_one({"id": foreign})) is not None
+
+
+def test_single_delete_leaves_batch_marked_rows_alone(server, mock_db, client, auth_headers, seller):
+    own = insert_product(server, mock_db, seller["id"])
+    asyncio.run(mock_db.products.update_one(
+        {"id": own}, {"$set": {"batch_op": "other", "deleting_until": datetime.utcnow() + timedelta(seconds=60)}}
+    ))
+    assert client.delete(f"/api/products/{own}", headers=auth_headers).status_code == 404
+    assert asyncio.run(mock_db.images.find_one({"key": f"{own}.png"}))["refs"] == 1
@@ -0,0 +1,85 @@
+import pytest
+
+SIZE = 100
+BODY = bytes(range(SIZE))
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", (0, 9)),
+    ("bytes=90-", (90, 99)),
+    ("bytes=90-500", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-500", (0, 99)),
+    (" bytes=5-5 ", (5, 5)),
+])
+def test_parse_byte_range_satisfiable(server, header, expected):
+    assert server.parse_byte_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=0-1,4-5",
+    "bytes=9-3",
+    "bytes=-",
+    "bytes=abc",
+    "items=0-9",
+])
+def test_parse_byte_range_ignores_unsupported_or_malformed(server, header):
+    assert server.parse_byte_range(header, SIZE) is None
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=100-", SIZE),
+    ("bytes=150-200", SIZE),
+    ("bytes=-0", SIZE),
+    ("bytes=-5", 0),
+])
+def test_parse_byte_range_unsatisfiable(server, header, size):
+    with pytest.raises(server.RangeNotSatisfiable):
+        server.parse_byte_range(header, size)
+
+
+def test_if_range_matches(server):
+    etag, last_modified = '"abc"', "Mon, 05 Oct 2026 10:00:00 GMT"
+    assert server.if_range_matches(None, etag, last_modified)
+    assert server.if_range_matches('"abc"', etag, last_modified)
+    assert server.if_range_matches(last_modified, etag, last_modified)
+    assert not server.if_range_matches('"other"', etag, last_modified)
+    assert not server.if_range_matches('W/"abc"', etag, last_modified)
+    assert not server.if_range_matches('W/"abc"', 'W/"abc"', last_modified)
+    assert not server.if_range_matches("Sun, 04 Oct 2026 10:00:00 GMT", etag, last_modified)
+
+
+@pytest.fixture
+def client(client, server, monkeypatch, tmp_path):
+    (tmp_path / "photo.png").write_bytes(BODY)
+    monkeypatch.setattr(server, "uploads_dir", tmp_path)
+    return client
+
+
+def test_serve_upload_partial_content(client):
+    response = client.get("/uploads/photo.png", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 10-19/{SIZE}"
+    assert response.content == BODY[10:20]
+
+
+@pytest.mark.parametrize("header", ["bytes=0-1,4-5", "bytes=9-3"])
+def test_serve_upload_ignores_unsupported_ranges(client, header):
+    response = client.get("/uploads/photo.png", headers={"Range": header})
+    assert response.status_code == 200
+    assert response.content == BODY
+
+
+def test_serve_upload_rejects_unsatisfiable_range(client):
+    response = client.get("/uploads/photo.png", headers={"Range": "bytes=500-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{SIZE}"
+
+
+def test_serve_upload_if_range(client):
+    etag = client.get("/uploads/photo.png").headers["etag"]
+    matching = client.get("/uploads/photo.png", headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert matching.status_code == 206
+    stale = client.get("/uploads/photo.png", headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+    assert stale.status_code == 200
+    assert stale.content == BODY
@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+PNG_BYTES = b"\x89PNG\r\n\x1a\n" + b"image-bytes" * 10
+
+
+def stage(tmp_path, data=PNG_BYTES):
+    key = f"{hashlib.sha256(data).hexdigest()}.png"
+    staged = tmp_path / f"{key}.part"
+    staged.write_bytes(data)
+    return staged, key, len(data)
+
+
+async def age_image(db, key):
+    """Backdate an entry so it is past the GC grace period"""
+    await db.images.update_one({"key": key}, {"$set": {"updated_at": datetime.utcnow() - timedelta(seconds=5)}})
+
+
+def test_gc_removes_unreferenced_image(server, mock_db, store, tmp_path):
+    async def scenario():
+        key = await server.store_staged_image(*stage(tmp_path))
+        await age_image(mock_db, key)
+        await server.gc_images()
+        return key
+
+    key = asyncio.run(scenario())
+    assert not store.path_for(key).exists()
+    assert asyncio.run(mock_db.images.find_one({"key": key})) is None
+
+
+def test_gc_keeps_referenced_image(server, mock_db, store, tmp_path):
+    async def scenario():
+        key = await server.store_staged_image(*stage(tmp_path))
+        await server.adjust_image_refs([key], 1)
+        await age_image(mock_db, key)
+        await server.gc_images()
+        return key
+
+    key = asyncio.run(scenario())
+    assert store.path_for(key).exists()
+    assert asyncio.run(mock_db.images.find_one({"key": key}))["refs"] == 1
+
+
+def test_upload_during_gc_waits_and_rewrites_blob(server, mock_db, store, tmp_path, monkeypatch):
+    deleting = threading.Event()
+    release = threading.Event()
+    original_delete = store.delete
+
+    def slow_delete(key):
+        deleting.set()
+        release.wait(5)
+        original_delete(key)
+
+    monkeypatch.setattr(store, "delete", slow_delete)
+
+    async def scenario():
+        key = await server.store_staged_image(*stage(tmp_path))
+        await age_image(mock_db, key)
+
+        gc = asyncio.create_task(server.gc_images())
+        while not deleting.is_set():
+            await asyncio.sleep(0.01)
+
+        # The same bytes are uploaded again while GC is deleting the blob
+        upload = asyncio.create_task(server.store_staged_image(*stage(tmp_path)))
+        await asyncio.sleep(0.1)
+        assert not upload.done(), "upload must wait for the GC lease"
+
+        release.set()
+        await gc
+        await upload
+        return key
+
+    key = asyncio.run(scenario())
+    assert store.path_for(key).read_bytes() == PNG_BYTES
+    row = asyncio.run(mock_db.images.find_one({"key": key}))
+    assert row is not None and row.get("deleting_until") is None
+
+
+def test_register_takes_over_lapsed_gc_lease(server, mock_db, store, tmp_path):
+    async def scenario():
+        key = await server.store_staged_image(*stage(tmp_path))
+        await mock_db.images.update_one(
+            {"key": key},
+            {"$set": {"deleting_until": datetime.utcnow() - timedelta(seconds=1), "variants": {"grid": {}}}}
+        )
+        overwrite = await server.register_image(key, len(PNG_BYTES))
+        return key, overwrite
+
+    key, overwrite = asyncio.run(scenario())
+    assert overwrite is True
+    row = asyncio.run(mock_db.images.find_one({"key": key}))
+    assert "deleting_until" not in row and "variants" not in row
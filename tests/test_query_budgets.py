@@ -0,0 +1,68 @@
+"""Round-trip budgets under QUERY_DEBUG=raise, against a real MongoDB.
+
+mongomock-motor bypasses the command listener, so these tests need the server
+named by MONGO_URL and are skipped when it is not reachable.
+"""
+import asyncio
+import os
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def live_db_url(server):
+    pymongo = pytest.importorskip("pymongo")
+    url = os.environ["MONGO_URL"]
+    try:
+        pymongo.MongoClient(url, serverSelectionTimeoutMS=500).admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        pytest.skip(f"MongoDB not reachable at {url}")
+    return url
+
+
+def test_authenticated_routes_stay_within_budget_with_cold_user_cache(server, live_db_url, monkeypatch):
+    httpx = pytest.importorskip("httpx")
+    monkeypatch.setattr(server, "QUERY_DEBUG", "raise")
+    monkeypatch.setattr(server, "response_cache", server.ResponseCache(16, 60))
+
+    async def scenario():
+        client = server.AsyncIOMotorClient(live_db_url, event_listeners=[server.CommandStatsListener()])
+        db = client[f"thrifthub_budget_{uuid.uuid4().hex[:8]}"]
+        monkeypatch.setattr(server, "db", db)
+        try:
+            await server.ensure_indexes()
+            seller = server.User(name="Seller", email="seller@example.com", phone="1").dict()
+            buyer = server.User(name="Buyer", email="buyer@example.com", phone="2").dict()
+            await db.users.insert_many([dict(seller), dict(buyer)])
+            product = server.Product(
+                title="Lamp", description="Brass lamp", price=25, category="home", condition="good",
+                location="Berlin", seller_id=seller["id"]
+            ).dict()
+            await db.products.insert_one(dict(product))
+
+            def auth(user):
+                return {"Authorization": f"Bearer {server.create_access_token({'sub': user['id']})}"}
+
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+                async def call(method, path, user, **kwargs):
+                    # Every request starts with a cold user cache
+                    server.user_cache.clear()
+                    response = await http.request(method, path, headers=auth(user), **kwargs)
+                    assert response.status_code < 400, f"{method} {path}: {response.text}"
+
+                pid = product["id"]
+                await call("POST", f"/api/favorites/{pid}", buyer)
+                await call("GET", "/api/favorites", buyer)
+                await call("POST", "/api/messages", buyer,
+                           json={"recipient_id": seller["id"], "product_id": pid, "content": "Still available?"})
+                await call("GET", "/api/messages", seller)
+                await call("GET", f"/api/messages/{buyer['id']}_{pid}", seller)
+                await call("DELETE", f"/api/favorites/{pid}", buyer)
+                await call("DELETE", f"/api/products/{pid}", seller)
+        finally:
+            await client.drop_database(db.name)
+            client.close()
+
+    asyncio.run(scenario())
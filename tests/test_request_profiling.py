@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+import pytest
+
+
+@pytest.fixture
+def metrics(server, monkeypatch):
+    fresh = server.Metrics()
+    monkeypatch.setattr(server, "metrics", fresh)
+    return fresh
+
+
+def test_duration_excludes_background_tasks(server, metrics):
+    from fastapi import BackgroundTasks, FastAPI
+    from starlette.testclient import TestClient
+
+    app = FastAPI()
+
+    @app.post("/work")
+    async def work(background_tasks: BackgroundTasks):
+        background_tasks.add_task(time.sleep, 0.3)
+        return {"ok": True}
+
+    app.add_middleware(server.RequestProfilingMiddleware)
+    assert TestClient(app).post("/work").status_code == 200
+
+    count, total = metrics.summaries[("http_request_duration_seconds", (("method", "POST"), ("route", "/work")))]
+    assert count == 1
+    assert total < 0.3
+
+
+def test_threshold_flush_runs_outside_the_request_context(server, monkeypatch):
+    counter = server.ViewCounter(interval=60, threshold=1)
+    seen = []
+
+    async def fake_flush():
+        seen.append(server.request_stats.get())
+
+    monkeypatch.setattr(counter, "flush", fake_flush)
+
+    async def scenario():
+        server.request_stats.set(server.RequestStats())
+        counter.record("product-1")
+        await asyncio.gather(*counter._flushes)
+
+    asyncio.run(scenario())
+    assert seen == [None]
@@ -0,0 +1,71 @@
+import asyncio
+
+ROUTE = "GET /api/products"
+
+
+def make_compute(calls, value, tags=("products",), delay=0):
+    async def compute():
+        calls.append(value)
+        if delay:
+            await asyncio.sleep(delay)
+        return value, list(tags)
+    return compute
+
+
+def test_invalidate_evicts_tagged_local_entries(server):
+    cache = server.ResponseCache(maxsize=16, ttl=60)
+    calls = []
+
+    async def scenario():
+        await cache.get_or_compute(ROUTE, {"page": 1}, make_compute(calls, "feed"))
+        await cache.get_or_compute("GET /api/users/u1", {}, make_compute(calls, "user", tags=("user:u1",)))
+        await cache.invalidate("products")
+
+    asyncio.run(scenario())
+    assert cache.peek(ROUTE, {"page": 1}) is None
+    assert cache.peek("GET /api/users/u1", {}) == "user"
+
+
+def test_shared_hit_registers_tags(server, mock_db):
+    writer = server.ResponseCache(maxsize=16, ttl=60, shared=mock_db.response_cache)
+    reader = server.ResponseCache(maxsize=16, ttl=60, shared=mock_db.response_cache)
+    calls = []
+
+    async def scenario():
+        await writer.get_or_compute(ROUTE, {}, make_compute(calls, "feed"))
+        # A second worker fills its local tier from the shared tier
+        value = await reader.get_or_compute(ROUTE, {}, make_compute(calls, "recomputed"))
+        assert value == "feed"
+        assert reader.peek(ROUTE, {}) == "feed"
+        await reader.invalidate("products")
+        assert await mock_db.response_cache.count_documents({}) == 0
+
+    asyncio.run(scenario())
+    assert calls == ["feed"]
+    assert reader.peek(ROUTE, {}) is None
+
+
+def test_concurrent_misses_share_one_computation(server):
+    cache = server.ResponseCache(maxsize=16, ttl=60)
+    calls = []
+
+    async def scenario():
+        compute = make_compute(calls, "feed", delay=0.05)
+        return await asyncio.gather(*(cache.get_or_compute(ROUTE, {}, compute) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["feed"] * 5
+    assert calls == ["feed"]
+
+
+def test_result_computed_across_invalidation_is_not_cached(server):
+    cache = server.ResponseCache(maxsize=16, ttl=60)
+    calls = []
+
+    async def scenario():
+        pending = asyncio.create_task(cache.get_or_compute(ROUTE, {}, make_compute(calls, "stale", delay=0.05)))
+        await asyncio.sleep(0.01)
+        await cache.invalidate("products")
+        assert await pending == "stale"
+
+    asyncio.run(scenario())
+    assert cache.peek(ROUTE, {}) is None
@@ -0,0 +1,83 @@
+"""S3ImageStore against moto's in-process S3 (the same API MinIO serves)."""
+import asyncio
+import hashlib
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+BUCKET = "thrifthub-test"
+
+
+@pytest.fixture
+def s3_store(server, mock_db, monkeypatch, tmp_path):
+    moto = pytest.importorskip("moto")
+    mock_aws = getattr(moto, "mock_aws", None) or moto.mock_s3
+    for name, value in {
+        "AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing", "AWS_DEFAULT_REGION": "us-east-1",
+    }.items():
+        monkeypatch.setenv(name, value)
+    with mock_aws():
+        store = server.S3ImageStore(bucket=BUCKET, public_url="https://cdn.example.com", prefix="images/")
+        store.client.create_bucket(Bucket=BUCKET)
+        monkeypatch.setattr(server, "image_store", store)
+        monkeypatch.setattr(server, "upload_tmp_dir", tmp_path)
+        monkeypatch.setattr(server, "IMAGE_GC_GRACE_SECONDS", 0)
+        yield store
+
+
+def png_bytes(server):
+    buffer = io.BytesIO()
+    server.Image.new("RGB", (64, 48), "orange").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def stage(tmp_path, data):
+    key = f"{hashlib.sha256(data).hexdigest()}.png"
+    staged = tmp_path / f"{key}.part"
+    staged.write_bytes(data)
+    return staged, key, len(data)
+
+
+def test_s3_store_round_trip(server, s3_store, tmp_path):
+    staged, key, _ = stage(tmp_path, png_bytes(server))
+    s3_store.put_file(staged, key)
+    assert not staged.exists()
+    assert s3_store.exists(key)
+    assert s3_store.url_for(key) == f"https://cdn.example.com/images/{key}"
+    assert s3_store.local_copy(key, tmp_path).read_bytes() == png_bytes(server)
+    s3_store.delete(key)
+    assert not s3_store.exists(key)
+
+
+def test_s3_gc_removes_unreferenced_blob(server, mock_db, s3_store, tmp_path):
+    async def scenario():
+        key = await server.store_staged_image(*stage(tmp_path, png_bytes(server)))
+        await mock_db.images.update_one({"key": key}, {"$set": {"updated_at": datetime.utcnow() - timedelta(seconds=5)}})
+        await server.gc_images()
+        return key
+
+    key = asyncio.run(scenario())
+    assert not s3_store.exists(key)
+
+
+def test_s3_variants_download_off_the_event_loop(server, mock_db, s3_store, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "image_executor", ThreadPoolExecutor(max_workers=1))
+    download_threads = []
+    original = s3_store.local_copy
+
+    def recording_local_copy(key, directory):
+        download_threads.append(threading.current_thread())
+        return original(key, directory)
+
+    monkeypatch.setattr(s3_store, "local_copy", recording_local_copy)
+
+    async def scenario():
+        key = await server.store_staged_image(*stage(tmp_path, png_bytes(server)))
+        return await server.image_variants_for(key), threading.current_thread()
+
+    variants, loop_thread = asyncio.run(scenario())
+    assert download_threads and loop_thread not in download_threads
+    assert s3_store.exists(variants["grid"]["webp"])
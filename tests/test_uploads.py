@@ -0,0 +1,62 @@
+PNG_BYTES = b"\x89PNG\r\n\x1a\n" + b"\x00" * 256
+
+PRODUCT_FORM = {
+    "title": "Desk lamp",
+    "description": "Brass desk lamp, works fine",
+    "price": "25",
+    "category": "home",
+    "condition": "good",
+    "location": "Berlin",
+}
+
+
+def test_create_product_with_multipart_images(client, store, auth_headers):
+    response = client.post(
+        "/api/products",
+        data=PRODUCT_FORM,
+        files=[
+            ("image_files", ("lamp.png", PNG_BYTES, "image/png")),
+            ("image_files", ("lamp-side.png", PNG_BYTES + b"side", "image/png")),
+        ],
+        headers=auth_headers,
+    )
+    assert response.status_code == 200, response.text
+    images = response.json()["images"]
+    assert len(images) == 2
+    assert all(store.path_for(url.rsplit("/", 1)[-1]).exists() for url in images)
+
+
+def test_create_product_with_single_multipart_image(client, store, auth_headers):
+    response = client.post(
+        "/api/products",
+        data=PRODUCT_FORM,
+        files=[("image_files", ("lamp.png", PNG_BYTES, "image/png"))],
+        headers=auth_headers,
+    )
+    assert response.status_code == 200, response.text
+    assert len(response.json()["images"]) == 1
+
+
+def test_oversized_image_part_is_rejected(server, client, store, auth_headers, monkeypatch):
+    monkeypatch.setattr(server, "MAX_IMAGE_BYTES", 128)
+    response = client.post(
+        "/api/products",
+        data=PRODUCT_FORM,
+        files=[("image_files", ("huge.png", PNG_BYTES, "image/png"))],
+        headers=auth_headers,
+    )
+    assert response.status_code == 413
+
+
+def test_oversized_request_413_carries_cors_headers(client):
+    response = client.post(
+        "/api/products",
+        content=b"x",
+        headers={
+            "Content-Type": "multipart/form-data; boundary=x",
+            "Content-Length": str(10 ** 12),
+            "Origin": "https://shop.example.com",
+        },
+    )
+    assert response.status_code == 413
+    assert "access-control-allow-origin" in response.headers
@@ -0,0 +1,59 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+
+def request_with(server, if_match=None):
+    from starlette.requests import Request
+
+    headers = [(b"if-match", if_match.encode())] if if_match is not None else []
+    return Request({"type": "http", "method": "PUT", "headers": headers})
+
+
+def test_version_etag_is_strong(server):
+    etag = server.version_etag("p1", datetime(2026, 1, 1), 3, seller_version=2)
+    assert not etag.startswith("W/")
+    assert etag.endswith('-s2-v3"')
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("*", None),
+    ('"p1-1767225600000-v3"', 3),
+    ('"p1-1767225600000-s2-v4"', 4),
+    ("5", 5),
+    ('W/"p1-1767225600000-v3", "p1-1767225600000-v7"', 7),
+])
+def test_if_match_version(server, header, expected):
+    assert server.if_match_version(request_with(server, header)) == expected
+
+
+@pytest.mark.parametrize("header", ['W/"p1-1767225600000-v3"', "garbage"])
+def test_if_match_rejects_weak_or_unknown_tags(server, header):
+    from fastapi import HTTPException
+
+    with pytest.raises(HTTPException) as error:
+        server.if_match_version(request_with(server, header))
+    assert error.value.status_code == 412
+
+
+def test_put_etag_matches_detail_etag(server, mock_db, client, auth_headers):
+    seller = asyncio.run(mock_db.users.find_one({}, {"_id": 0}))
+    product = server.Product(
+        title="Lamp", description="Brass lamp", price=25, category="home", condition="good",
+        location="Berlin", seller_id=seller["id"]
+    ).dict()
+    asyncio.run(mock_db.products.insert_one(dict(product)))
+    path = f"/api/products/{product['id']}"
+
+    etag = client.get(path).headers["etag"]
+    updated = client.put(path, json={"price": 20}, headers={**auth_headers, "If-Match": etag})
+    assert updated.status_code == 200, updated.text
+    assert updated.json()["seller"]["id"] == seller["id"]
+
+    assert client.get(path).headers["etag"] == updated.headers["etag"]
+    stale = client.put(path, json={"price": 15}, headers={**auth_headers, "If-Match": etag})
+    assert stale.status_code == 412
+    weak = client.put(path, json={"price": 15}, headers={**auth_headers, "If-Match": f"W/{updated.headers['etag']}"})
+    assert weak.status_code == 412
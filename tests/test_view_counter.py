@@ -0,0 +1,50 @@
+import asyncio
+from types import SimpleNamespace
+
+
+class FailingProducts:
+    """bulk_write that applies every operation except the listed indexes"""
+
+    def __init__(self, failing_indexes, error=None):
+        self.failing_indexes = failing_indexes
+        self.error = error
+        self.applied = []
+
+    async def bulk_write(self, operations, ordered=True):
+        from pymongo.errors import BulkWriteError
+
+        if self.error is not None:
+            raise self.error
+        write_errors = []
+        for index, operation in enumerate(operations):
+            if index in self.failing_indexes:
+                write_errors.append({"index": index, "code": 2, "errmsg": "failed", "op": {}})
+            else:
+                self.applied.append(operation)
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors, "nInserted": 0})
+
+
+def test_partial_bulk_write_requeues_only_failed_increments(server, monkeypatch):
+    products = FailingProducts(failing_indexes={1})
+    monkeypatch.setattr(server, "db", SimpleNamespace(products=products))
+    counter = server.ViewCounter(interval=60, threshold=1000)
+    for product_id in ["a", "b", "b", "c"]:
+        counter.record(product_id)
+
+    asyncio.run(counter.flush())
+    assert len(products.applied) == 2
+    assert counter.pending == {"b": 2}
+    assert counter.pending_total == 2
+
+
+def test_failed_flush_requeues_everything(server, monkeypatch):
+    products = FailingProducts(failing_indexes=set(), error=RuntimeError("connection reset"))
+    monkeypatch.setattr(server, "db", SimpleNamespace(products=products))
+    counter = server.ViewCounter(interval=60, threshold=1000)
+    for product_id in ["a", "b", "b"]:
+        counter.record(product_id)
+
+    asyncio.run(counter.flush())
+    assert counter.pending == {"a": 1, "b": 2}
+    assert counter.pending_total == 3